@@ -0,0 +1,143 @@
+"""Measures the import time of each Lambda handler module and the time to
+create the database engine, and compares them with the recorded budget in
+``cold_start_budget.json``.
+
+Each measurement runs in a fresh interpreter with ``python -X importtime``
+and the same module search path the function gets in Lambda (its own code
+plus the shared layer), so results are comparable between commits. The
+import time is the median cumulative time reported for the handler module.
+
+    python benchmarks/cold_start.py [--repeat 5] [--check]
+
+``--check`` exits with a non-zero status when a handler is over budget.
+Handlers whose dependencies are not installed are reported as skipped.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+LAYER = os.path.join(SRC, 'layers', 'shared')
+BUDGET_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'cold_start_budget.json')
+
+# Handler module -> (function code directory, creates a database engine)
+HANDLERS = {
+    'api': ('functions/events/api', False),
+    'install': ('functions/install', False),
+    'oauth_redirect': ('functions/oauth_redirect', True),
+    'user_events': ('functions/events/user_events', True),
+    'dev_database': ('functions/dev/database', True),
+    'trade_plan': ('functions/trade_plan', True),
+    'database_initializer': ('cloudformation/database_initializer', True)
+}
+
+ENGINE_SNIPPET = \
+    'import time; start = time.perf_counter(); ' \
+    'from jtg.database import get_engine; get_engine(); ' \
+    'print((time.perf_counter() - start) * 1000)'
+
+
+def handler_env(code_dir):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(SRC, code_dir), LAYER])
+    # Placeholder settings so modules that read them at import time load.
+    env.setdefault('DATABASE_ENDPOINT', 'localhost')
+    env.setdefault('DATABASE_PORT', '3306')
+    env.setdefault('DROP_DATABASE', '0')
+    return env
+
+
+def import_time_ms(module, env):
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1000
+
+    raise RuntimeError(f'No import time reported for {module}')
+
+
+def engine_time_ms(module, env):
+    proc = subprocess.run(
+        [sys.executable, '-c', f'import {module}; {ENGINE_SNIPPET}'],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    return float(proc.stdout.strip().splitlines()[-1])
+
+
+def measure(repeat):
+    results = dict()
+
+    for module, (code_dir, uses_database) in HANDLERS.items():
+        env = handler_env(code_dir)
+        try:
+            result = {
+                'import_ms': round(statistics.median(
+                    import_time_ms(module, env) for _ in range(repeat)), 1)
+            }
+            if uses_database:
+                result['engine_ms'] = round(statistics.median(
+                    engine_time_ms(module, env) for _ in range(repeat)), 1)
+        except RuntimeError as error:
+            result = {'skipped': str(error)}
+
+        results[module] = result
+
+    return results
+
+
+def over_budget(results, budget):
+    failures = list()
+
+    for module, result in results.items():
+        for key, limit in budget.get(module, dict()).items():
+            if key in result and result[key] > limit:
+                failures.append(f'{module} {key}: {result[key]} > {limit}')
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+
+    with open(BUDGET_FILE) as f:
+        budget = json.load(f)
+
+    results = measure(args.repeat)
+    failures = over_budget(results, budget)
+
+    print(json.dumps(
+        {'benchmark': 'cold_start', 'results': results, 'over_budget': failures},
+        indent=2
+    ))
+
+    if args.check and failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""Benchmarks the user_events hot paths against synthetic teams.
+
+For each team size a team is generated in a local database with random
+``have``/``need`` cards (each card is flagged with probability
+``--density``). The benchmark then times:
+
+* ``get_or_create_user`` for an existing and a new user
+* ``process_command`` for every command. The commands that write run for
+  a new user each time, set up so the command changes their cards or
+  setting, so the ``UPDATE`` and commit are timed rather than a no-op
+* ``command_show_trades`` and ``command_show_mine`` called directly, and
+  ``find_trades`` to time ``show trades`` without its result cache
+
+Each operation reports the median, p95 and minimum time in milliseconds,
+plus the number of SQL statements it ran. The results are printed as one
+JSON object, so they can be saved and compared between commits.
+
+    python benchmarks/hot_paths.py [--sizes 100,1000,10000,100000]
+        [--density 0.3] [--repeat 20] [--database-url URL] [--output FILE]
+
+The default database is a temporary SQLite file. Pass ``--database-url``
+to run against MySQL instead (e.g. a local container). Tables are created
+when missing and each run uses its own teams.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.join(SRC, 'functions', 'events', 'user_events'))
+sys.path.insert(0, os.path.join(SRC, 'layers', 'shared'))
+
+DEFAULT_SIZES = '100,1000,10000,100000'
+INSERT_CHUNK = 5000
+
+COMMAND_MESSAGES = [
+    'help',
+    'show trades',
+    'show trade chains',
+    'show plan',
+    'show mine',
+    'more'
+]
+
+# Commands that write -> the card bits a new user needs set (have, need)
+# and cleared (have, need) for the command to change something
+WRITE_COMMANDS = {
+    'i have 1 2 3': ((0, 0), (0b111, 0)),
+    'i need 4 5 6': ((0, 0), (0, 0b111000)),
+    'i traded 1 for 4': ((0b1, 0b1000), (0, 0)),
+    'notify on': ((0, 0), (0, 0))
+}
+
+
+def random_mask(rng, density, card_count, exclude=0):
+    mask = 0
+    for i in range(card_count):
+        if rng.random() < density:
+            mask |= 1 << i
+    return mask & ~exclude
+
+
+def generate_team(session, models, size, density, rng):
+    """Creates a team with ``size`` users and returns the team and the Slack
+    user IDs that were created.
+    """
+    run_id = uuid.uuid4().hex[:8]
+    team = models.SlackTeams(
+        team_id=f'T{run_id}',
+        team_name=f'Benchmark {size}',
+        access_token='xoxp-benchmark',
+        bot_user_id='UBOT',
+        bot_access_token='xoxb-benchmark'
+    )
+    session.add(team)
+    session.commit()
+
+    user_ids = [f'U{i:07d}' for i in range(size)]
+
+    for start in range(0, size, INSERT_CHUNK):
+        rows = list()
+        for user_id in user_ids[start:start + INSERT_CHUNK]:
+            have = random_mask(rng, density, models.CARD_COUNT)
+            rows.append({
+                'slack_team_id': team.id,
+                'user_id': user_id,
+                'have_cards': have,
+                'need_cards': random_mask(
+                    rng, density, models.CARD_COUNT, exclude=have)
+            })
+        session.bulk_insert_mappings(models.SlackUsers, rows)
+        session.commit()
+
+    return team, user_ids
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        self.count += 1
+
+
+def time_operation(func, repeat, counter, setup=None):
+    """Calls ``func`` ``repeat`` times and returns its timings. ``setup(i)``
+    is called first when given, untimed, and its result is passed to
+    ``func`` instead of ``i``.
+    """
+    timings = list()
+    queries = 0
+
+    for i in range(repeat):
+        arg = setup(i) if setup else i
+        before = counter.count
+        start = time.perf_counter()
+        func(arg)
+        timings.append((time.perf_counter() - start) * 1000)
+        queries += counter.count - before
+
+    timings.sort()
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[int(0.95 * (len(timings) - 1))], 3),
+        'min_ms': round(timings[0], 3),
+        'queries': round(queries / repeat, 1)
+    }
+
+
+def benchmark_size(user_events, models, get_session, counter, size,
+                   density, repeat, rng):
+    session = get_session()
+    team, user_ids = generate_team(session, models, size, density, rng)
+    user_id = rng.choice(user_ids)
+    results = dict()
+
+    def event_data(user):
+        return {'team_id': team.team_id, 'event': {'user': user}}
+
+    def existing_user(i):
+        user_events.get_or_create_user(session, event_data(user_id))
+
+    def new_user(i):
+        user_events.get_or_create_user(session, event_data(f'N{i:07d}'))
+
+    results['get_or_create_user (existing)'] = time_operation(
+        existing_user, repeat, counter)
+    results['get_or_create_user (new)'] = time_operation(
+        new_user, repeat, counter)
+
+    user = user_events.find_user(session, team.id, user_id)
+
+    for message in COMMAND_MESSAGES:
+        results[f'process_command ({message})'] = time_operation(
+            lambda i: user_events.process_command(
+                user_events.read_command(message), session, user),
+            repeat,
+            counter
+        )
+
+    for n, (message, (set_bits, clear_bits)) in \
+            enumerate(WRITE_COMMANDS.items()):
+        def new_writer(i):
+            have = random_mask(rng, density, models.CARD_COUNT)
+            have = (have | set_bits[0]) & ~clear_bits[0]
+            need = random_mask(rng, density, models.CARD_COUNT, exclude=have)
+            writer = models.SlackUsers(
+                slack_team_id=team.id,
+                user_id=f'W{n}{i:07d}',
+                have_cards=have,
+                need_cards=(need | set_bits[1]) & ~clear_bits[1]
+            )
+            session.add(writer)
+            session.commit()
+            return writer
+
+        results[f'process_command ({message})'] = time_operation(
+            lambda writer: user_events.process_command(
+                user_events.read_command(message), session, writer),
+            repeat,
+            counter,
+            setup=new_writer
+        )
+
+    results['command_show_trades'] = time_operation(
+        lambda i: user_events.command_show_trades(session, user),
+        repeat,
+        counter
+    )
+    results['find_trades (uncached)'] = time_operation(
+        lambda i: user_events.find_trades(session, user),
+        repeat,
+        counter
+    )
+    results['command_show_mine'] = time_operation(
+        lambda i: user_events.command_show_mine(session, user),
+        repeat,
+        counter
+    )
+
+    session.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default=DEFAULT_SIZES)
+    parser.add_argument('--density', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database-url')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    database_file = None
+    if not args.database_url:
+        database_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        args.database_url = f'sqlite:///{database_file.name}'
+
+    # jtg.database reads its settings at import time.
+    os.environ['DATABASE_URL'] = args.database_url
+
+    import user_events
+    from jtg import models
+    from jtg.database import get_engine, get_session
+
+    engine = get_engine()
+    models.Base.metadata.create_all(engine)
+    counter = QueryCounter(engine)
+    rng = random.Random(args.seed)
+
+    results = dict()
+    try:
+        for size in (int(s) for s in args.sizes.split(',')):
+            results[str(size)] = benchmark_size(
+                user_events, models, get_session, counter, size,
+                args.density, args.repeat, rng
+            )
+    finally:
+        if database_file:
+            os.remove(database_file.name)
+
+    output = json.dumps(
+        {
+            'benchmark': 'hot_paths',
+            'database': engine.dialect.name,
+            'density': args.density,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'results': results
+        },
+        indent=2
+    )
+    print(output)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
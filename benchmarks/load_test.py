@@ -0,0 +1,427 @@
+"""End-to-end load test of the Slack event path on one machine.
+
+Events are sent to ``api.lambda_handler`` from ``--concurrency`` threads.
+The SNS client is replaced with an in-process topic that queues the
+published messages, and ``--workers`` threads deliver them to
+``user_events.lambda_handler``. With ``--source sqs`` (the default) each
+invocation is an SQS batch of up to ``--batch-size`` messages, like the
+``UserEventsSource=SQS`` deployment. With ``--source sns`` each invocation
+has a single record, as SNS never delivers more than one. Replies go to a
+local fake of the Slack Web API, so an event is complete when its reply
+reaches that server.
+
+    python benchmarks/load_test.py [--events 2000] [--teams 5] [--users 500]
+        [--concurrency 8] [--workers 4] [--source sqs|sns] [--batch-size 10]
+        [--rate 0] [--retry-rate 0.05] [--slack-latency 0] [--replay FILE]
+        [--database-url URL] [--output FILE]
+
+Synthetic events are a mix of commands from random users. ``--replay``
+sends recorded event callback bodies instead, one JSON object per line.
+Every event gets its own channel so its reply can be matched to it.
+``--retry-rate`` redelivers that fraction of events with
+``X-Slack-Retry-Num`` like Slack does after a slow acknowledgement.
+
+Prints events per second, p50/p99 end-to-end and API latency in
+milliseconds, and the database queries per event as JSON. All of the
+workers share one process, so the database pool and caches behave like a
+single warm container handling concurrent invocations. Each worker has its
+own reply scheduler, which isn't thread-safe. Compare ``completed`` with
+``events`` to spot replies that never arrived.
+Needs boto3 installed, as the Lambda runtime provides it.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCHMARKS, '..', 'src')
+sys.path.insert(0, os.path.join(SRC, 'functions', 'events', 'user_events'))
+sys.path.insert(0, os.path.join(SRC, 'functions', 'events', 'api'))
+sys.path.insert(0, os.path.join(SRC, 'layers', 'shared'))
+
+from hot_paths import QueryCounter  # noqa: E402
+
+# Command text -> relative weight of synthetic events
+COMMAND_MIX = {
+    'show trades': 35,
+    'i have 1 2 3': 10,
+    'i need 4-6': 10,
+    'i have 7, 9, 12': 10,
+    'i need 13 14 15': 10,
+    'i traded 1 for 4': 5,
+    'show mine': 10,
+    'more': 5,
+    'help': 5
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p / 100 * len(values)))], 3)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeSlack(object):
+    """A local stand-in for the Slack Web API that records when each
+    channel receives ``chat.postMessage``.
+    """
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.received = dict()
+        self.messages = 0
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                with fake.lock:
+                    fake.messages += 1
+                    fake.received.setdefault(
+                        body.get('channel'), time.perf_counter())
+
+                response = json.dumps({'ok': True}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class LocalTopic(object):
+    """An in-process stand-in for the SNS client used by the events API."""
+    def __init__(self):
+        self.messages = queue.Queue()
+
+    def publish(self, TopicArn, Message, MessageStructure=None):
+        self.messages.put(Message)
+        return {'MessageId': str(id(Message))}
+
+
+def synthetic_events(count, teams, users, rng):
+    commands = list(COMMAND_MIX)
+    weights = list(COMMAND_MIX.values())
+
+    for seq in range(count):
+        yield {
+            'type': 'event_callback',
+            'team_id': f'T{rng.randrange(teams):05d}',
+            'event_id': f'Ev{seq:08d}',
+            'event_time': int(time.time()),
+            'event': {
+                'type': 'message',
+                'user': f'U{rng.randrange(users):07d}',
+                'text': rng.choices(commands, weights)[0],
+                'channel': ''
+            }
+        }
+
+
+def replayed_events(path):
+    with open(path) as f:
+        for seq, line in enumerate(f):
+            if line.strip():
+                body = json.loads(line)
+                body.setdefault('event_id', f'Ev{seq:08d}')
+                yield body
+
+
+class WorkerOutbound(object):
+    """Stands in for ``user_events.outbound`` with a reply scheduler per
+    worker thread, since the scheduler isn't safe to share between threads.
+    """
+    def __init__(self, create):
+        self.create = create
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        scheduler = getattr(self.local, 'scheduler', None)
+        if scheduler is None:
+            scheduler = self.local.scheduler = self.create()
+
+        return getattr(scheduler, name)
+
+
+def create_teams(models, get_session, team_ids):
+    session = get_session()
+    existing = {
+        t.team_id for t in session.query(models.SlackTeams.team_id)}
+
+    session.add_all(
+        models.SlackTeams(
+            team_id=team_id,
+            team_name=f'Load test {team_id}',
+            access_token='xoxp-load-test',
+            bot_user_id='UBOT',
+            bot_access_token='xoxb-load-test'
+        ) for team_id in team_ids if team_id not in existing
+    )
+    session.commit()
+    session.close()
+
+
+def sns_event(messages):
+    return {
+        'Records': [
+            {'Sns': {'MessageId': str(id(m)), 'Message': m}} for m in messages
+        ]
+    }
+
+
+def sqs_event(messages):
+    return {
+        'Records': [
+            {
+                'messageId': str(id(m)),
+                'eventSource': 'aws:sqs',
+                'body': m
+            } for m in messages
+        ]
+    }
+
+
+def deliver(topic, user_events, source, batch_size, stop, errors, failures):
+    """Worker loop standing in for SNS or the SQS event source invoking
+    user_events.
+    """
+    build_event = sqs_event if source == 'sqs' else sns_event
+
+    while not stop.is_set():
+        try:
+            messages = [topic.messages.get(timeout=0.1)]
+        except queue.Empty:
+            continue
+
+        while len(messages) < batch_size:
+            try:
+                messages.append(topic.messages.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            result = user_events.lambda_handler(build_event(messages), None)
+            failures.extend((result or dict()).get('batchItemFailures', ()))
+        except Exception:
+            errors.append(sys.exc_info()[1])
+        finally:
+            for _ in messages:
+                topic.messages.task_done()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--teams', type=int, default=5)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--source', choices=('sqs', 'sns'), default='sqs')
+    parser.add_argument('--batch-size', type=int,
+                        help='Messages per SQS invocation (default 10)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Events per second to send (0 = unthrottled)')
+    parser.add_argument('--retry-rate', type=float, default=0.05)
+    parser.add_argument('--slack-latency', type=float, default=0,
+                        help='Milliseconds the fake Slack API takes')
+    parser.add_argument('--replay')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--database-url')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    if args.source == 'sns':
+        if args.batch_size not in (None, 1):
+            parser.error('SNS delivers one record per invocation')
+        args.batch_size = 1
+    elif args.batch_size is None:
+        args.batch_size = 10
+
+    slack = FakeSlack(args.slack_latency)
+    database_file = None
+    if not args.database_url:
+        database_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        args.database_url = f'sqlite:///{database_file.name}'
+
+    # The modules read their settings at import time.
+    os.environ.update({
+        'DATABASE_URL': args.database_url,
+        'SLACK_API_URL': slack.url,
+        'EVENTS_TOPIC': 'arn:local:events',
+        'METRICS_ENABLED': '0'
+    })
+    if args.database_url.startswith('sqlite'):
+        # SQLite connections can't be shared between threads.
+        os.environ['DATABASE_POOL'] = 'null'
+    else:
+        os.environ.setdefault('DATABASE_POOL', 'queue')
+        os.environ.setdefault('DATABASE_POOL_SIZE', str(args.workers))
+
+    import api
+    import user_events
+    from outbound import OutboundScheduler
+    from jtg import models
+    from jtg.database import get_engine, get_session
+
+    # The handlers log every request and reply at INFO.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    engine = get_engine()
+    models.Base.metadata.create_all(engine)
+    if engine.dialect.name == 'sqlite':
+        engine.execute('PRAGMA journal_mode=WAL')
+
+    rng = random.Random(args.seed)
+    if args.replay:
+        events = list(replayed_events(args.replay))
+    else:
+        events = list(synthetic_events(
+            args.events, args.teams, args.users, rng))
+
+    create_teams(models, get_session, {e['team_id'] for e in events})
+
+    topic = LocalTopic()
+    api.sns_client = topic
+    counter = QueryCounter(engine)
+
+    user_events.outbound = WorkerOutbound(
+        lambda: OutboundScheduler(
+            user_events.send_chat_message,
+            rate=user_events.OUTBOUND_RATE,
+            burst=user_events.OUTBOUND_BURST,
+            max_chars=user_events.OUTBOUND_MAX_CHARS
+        )
+    )
+
+    sent = dict()
+    api_latency = list()
+    duplicates = list()
+    errors = list()
+    failures = list()
+
+    def send(item):
+        seq, body = item
+        if args.rate:
+            delay = started + seq / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        body = dict(body, event=dict(body['event'], channel=f'C{seq:08d}'))
+        request = {'body': json.dumps(body), 'headers': dict()}
+
+        start = time.perf_counter()
+        sent[body['event']['channel']] = start
+        api.lambda_handler(request, None)
+        api_latency.append((time.perf_counter() - start) * 1000)
+
+        if rng.random() < args.retry_rate:
+            request['headers']['X-Slack-Retry-Num'] = '1'
+            result = api.lambda_handler(request, None)
+            duplicates.append(result['statusCode'] == 200)
+
+    stop = threading.Event()
+    workers = [
+        threading.Thread(
+            target=deliver,
+            args=(topic, user_events, args.source, args.batch_size, stop,
+                  errors, failures),
+            daemon=True
+        ) for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, enumerate(events)))
+
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        if all(c in slack.received for c in sent):
+            break
+        time.sleep(0.05)
+
+    elapsed = time.perf_counter() - started
+    stop.set()
+    slack.stop()
+
+    latency = [
+        (slack.received[c] - start) * 1000
+        for c, start in sent.items() if c in slack.received
+    ]
+    output = json.dumps(
+        {
+            'benchmark': 'load_test',
+            'database': engine.dialect.name,
+            'concurrency': args.concurrency,
+            'workers': args.workers,
+            'source': args.source,
+            'batch_size': args.batch_size,
+            'events': len(events),
+            'completed': len(latency),
+            'seconds': round(elapsed, 3),
+            'events_per_sec': round(len(latency) / elapsed, 1),
+            'latency_ms': {
+                'p50': percentile(latency, 50),
+                'p99': percentile(latency, 99),
+                'max': round(max(latency), 3) if latency else None
+            },
+            'api_latency_ms': {
+                'p50': percentile(api_latency, 50),
+                'p99': percentile(api_latency, 99)
+            },
+            'queries': counter.count,
+            'queries_per_event': round(counter.count / max(len(latency), 1), 2),
+            'slack_messages': slack.messages,
+            'retries_sent': len(duplicates),
+            'retries_dropped_by_api': sum(duplicates),
+            'batch_item_failures': len(failures),
+            'errors': [repr(e) for e in errors[:10]]
+        },
+        indent=2
+    )
+    print(output)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+    if database_file:
+        os.remove(database_file.name)
+
+
+if __name__ == '__main__':
+    main()
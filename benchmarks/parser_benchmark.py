@@ -0,0 +1,115 @@
+"""Micro-benchmark for the user_events command parser.
+
+Times ``commands.parse_command`` against the startswith() chain and
+per-command regexes it replaced, over a mix of typical messages. Prints one
+JSON object with the best time per message in nanoseconds.
+
+    python benchmarks/parser_benchmark.py [--number 20000]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.join(SRC, 'functions', 'events', 'user_events'))
+sys.path.insert(0, os.path.join(SRC, 'layers', 'shared'))
+
+from commands import CommandException, parse_command  # noqa: E402
+
+# Messages both parsers understand
+MESSAGES = [
+    'help',
+    'i have 1 2 3',
+    'i need 4 5 6 7 8 9 10',
+    'i traded 1 2 for 4 5',
+    'show trades',
+    'show mine',
+    "what's up?"
+]
+
+# Range, comma and 'all' syntax only the new parser understands
+EXTENDED_MESSAGES = [
+    'i have 1-6 9',
+    'i need 1, 2, 3',
+    'i have all',
+    'i traded 1-3 for 7, 8, 9'
+]
+
+LEGACY_I_HAVE_RE = re.compile(r'^i\s+have\s+([\d\s]+)(?<!\s)\s*$')
+LEGACY_I_NEED_RE = re.compile(r'^i\s+need\s+([\d\s]+)(?<!\s)\s*$')
+LEGACY_I_TRADED_RE = re.compile(
+    r'^i\s+traded\s+([\d\s]+)(?<!\s)\s+for\s+([\d\s]+)(?<!\s)\s*$')
+
+
+def legacy_parse_int_list(string):
+    try:
+        return [int(i) for i in string.strip().split()]
+    except (TypeError, ValueError):
+        return list()
+
+
+def legacy_parse(input_text):
+    """The previous parsing path, without the database work."""
+    if input_text.startswith('help'):
+        return 'help', ()
+    elif input_text.startswith('i have'):
+        match = LEGACY_I_HAVE_RE.match(input_text)
+        return 'i have', (legacy_parse_int_list(match.group(1)),) \
+            if match else None
+    elif input_text.startswith('i need'):
+        match = LEGACY_I_NEED_RE.match(input_text)
+        return 'i need', (legacy_parse_int_list(match.group(1)),) \
+            if match else None
+    elif input_text.startswith('i traded'):
+        match = LEGACY_I_TRADED_RE.match(input_text)
+        return 'i traded', (
+            legacy_parse_int_list(match.group(1)),
+            legacy_parse_int_list(match.group(2))
+        ) if match else None
+    elif input_text.startswith('show trades'):
+        return 'show trades', ()
+    elif input_text.startswith('show mine'):
+        return 'show mine', ()
+
+    return None, ()
+
+
+def parse(input_text):
+    try:
+        return parse_command(input_text)
+    except CommandException:
+        return None
+
+
+def run(func, messages, number):
+    def loop():
+        for message in messages:
+            func(message)
+
+    best = min(timeit.repeat(loop, number=number, repeat=5))
+    return round(best / (number * len(messages)) * 1e9, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {
+        'benchmark': 'parser',
+        'number': args.number,
+        'ns_per_message': {
+            'parse_command': run(parse, MESSAGES, args.number),
+            'legacy': run(legacy_parse, MESSAGES, args.number),
+            'parse_command_extended': run(
+                parse, EXTENDED_MESSAGES, args.number)
+        }
+    }
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
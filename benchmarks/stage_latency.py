@@ -0,0 +1,88 @@
+"""Computes latency percentiles from the per-stage metric lines that
+user_events writes in CloudWatch Embedded Metric Format.
+
+Reads captured logs from files or stdin, e.g. the output of
+``sam logs -n SlackUserEvents`` or ``aws logs filter-log-events``. Any text
+before the JSON object on a line (such as a timestamp) is ignored, as are
+lines that are not metric lines. Prints p50/p95/p99 in milliseconds for each
+stage, grouped by a dimension.
+
+    python benchmarks/stage_latency.py [--by Command|Team|none] [LOG ...]
+"""
+import argparse
+import fileinput
+import json
+import math
+from collections import defaultdict
+
+PERCENTILES = (50, 95, 99)
+
+
+def read_metric_lines(lines):
+    for line in lines:
+        start = line.find('{')
+        if start == -1:
+            continue
+
+        try:
+            data = json.loads(line[start:])
+        except ValueError:
+            continue
+
+        if isinstance(data, dict) and '_aws' in data:
+            yield data
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    rank = max(int(math.ceil(p / 100 * len(values))), 1)
+    return values[rank - 1]
+
+
+def aggregate(metric_lines, by=None):
+    """Groups the metric values by the given dimension and stage.
+
+    :returns: ``{group: {stage: {'count': n, 'p50': ..., ...}}}``
+    :rtype: dict
+    """
+    samples = defaultdict(lambda: defaultdict(list))
+
+    for data in metric_lines:
+        group = str(data.get(by, 'unknown')) if by else 'all'
+        for directive in data['_aws']['CloudWatchMetrics']:
+            for metric in directive['Metrics']:
+                value = data.get(metric['Name'])
+                if isinstance(value, (int, float)):
+                    samples[group][metric['Name']].append(value)
+
+    results = dict()
+    for group, stages in sorted(samples.items()):
+        results[group] = dict()
+        for stage, values in stages.items():
+            values.sort()
+            summary = {'count': len(values)}
+            summary.update({
+                f'p{p}': round(percentile(values, p), 3) for p in PERCENTILES
+            })
+            results[group][stage] = summary
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--by', default='Command')
+    parser.add_argument('logs', nargs='*')
+    args = parser.parse_args()
+
+    by = None if args.by == 'none' else args.by
+
+    with fileinput.input(args.logs) as lines:
+        results = aggregate(read_metric_lines(lines), by)
+
+    print(json.dumps(
+        {'report': 'stage_latency', 'by': by, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
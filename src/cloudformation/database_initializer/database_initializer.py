@@ -1,11 +1,14 @@
 import json
 import logging
 import os
+from urllib.request import Request, urlopen
 
-from botocore.vendored import requests
-from sqlalchemy import create_engine
+from sqlalchemy import inspect
 
-from models import Base
+from jtg.database import get_engine
+from jtg.models import Base
+
+from migrations import latest_version, mark_applied, run_migrations
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -13,13 +16,9 @@ logger.setLevel(logging.INFO)
 DATABASE_ENDPOINT = os.getenv('DATABASE_ENDPOINT')
 DATABASE_PORT = os.getenv('DATABASE_PORT')
 DATABASE_USERNAME = os.getenv('DATABASE_USERNAME')
-DATABASE_PASSWORD = os.getenv('DATABASE_PASSWORD')
 DROP_DATABASE = bool(int(os.getenv('DROP_DATABASE')))
 
-engine = create_engine(
-    f'mysql+pymysql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@'
-    f'{DATABASE_ENDPOINT}:{DATABASE_PORT}/jamfthegathering?charset=utf8'
-)
+engine = get_engine()
 
 
 def drop_database():
@@ -33,7 +32,8 @@ def create_database():
     Base.metadata.create_all(engine)
 
 
-def send_cf_response(event, context, success=True, reason='Unknown'):
+def send_cf_response(event, context, success=True, reason='Unknown',
+                     response_data=None):
     """This function sends a SUCCESS/FAILED response to the CloudFormation stack
     that invoked the Lambda function.
     """
@@ -47,33 +47,77 @@ def send_cf_response(event, context, success=True, reason='Unknown'):
     if not success:
         data['Reason'] = reason
 
+    if response_data:
+        data['Data'] = response_data
+
     headers = {
         'Content-Type': ''
     }
 
     logger.info(data)
     logger.info(f"Sending CloudFormation response to {event['ResponseURL']}")
-    resp = requests.put(
+    request = Request(
         event['ResponseURL'],
-        data=json.dumps(data),
+        data=json.dumps(data).encode(),
         headers=headers,
-        timeout=5
+        method='PUT'
     )
-    logger.info(resp.status_code)
+    with urlopen(request, timeout=5) as resp:
+        logger.info(resp.status)
+
+
+def target_schema_version(event):
+    """The ``DatabaseSchemaVersion`` property of the custom resource. Versions
+    above the latest migration apply every migration.
+
+    The deployed functions need every migration, so a version below the
+    latest one fails the deployment instead of leaving the schema behind.
+    """
+    version = event.get('ResourceProperties', {}).get('DatabaseSchemaVersion')
+    if not version:
+        return latest_version()
+
+    if int(version) < latest_version():
+        raise ValueError(
+            f'DatabaseSchemaVersion {version} is below the latest migration '
+            f'({latest_version()}), set it to {latest_version()} or higher'
+        )
+
+    return int(version)
 
 
 def lambda_handler(event, context):
     logger.info(f'Database Endpoint: {DATABASE_ENDPOINT}:{DATABASE_PORT}')
     logger.info(f'Database Username: {DATABASE_USERNAME}')
 
+    # Deleting the stack must never touch attendee data.
+    if event.get('RequestType') == 'Delete':
+        send_cf_response(event, context)
+        return {}
+
     try:
+        target_version = target_schema_version(event)
+
         if DROP_DATABASE:
             drop_database()
 
+        new_database = 'slack_users' not in inspect(engine).get_table_names()
         create_database()
-    except:
+
+        if new_database:
+            # create_all() built the current schema, nothing to migrate.
+            logger.info('New database, marking migrations as applied...')
+            mark_applied(engine, target_version)
+
+        version = run_migrations(
+            engine, target_version, context.get_remaining_time_in_millis)
+        logger.info(f'Database schema is at version {version}')
+    except Exception as error:
         logger.exception(
-            'An error occurred while trying to create the database!')
+            'An error occurred while trying to migrate the database!')
+        send_cf_response(
+            event, context, success=False, reason=str(error)[:256])
+        return {}
 
-    send_cf_response(event, context)
+    send_cf_response(event, context, response_data={'SchemaVersion': version})
     return {}
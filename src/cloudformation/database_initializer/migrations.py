@@ -0,0 +1,297 @@
+import logging
+import os
+
+from sqlalchemy import func, inspect
+
+from jtg.models import CARD_COUNT, SchemaMigrations
+
+logger = logging.getLogger()
+
+# Rows updated per transaction when backfilling, so a migration can run
+# while the bot is live without holding long locks.
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 1000))
+
+# Seconds of the invocation kept back when deciding whether to start another
+# migration, so there is time left to report the outcome to CloudFormation.
+MIGRATION_TIME_RESERVE = int(os.getenv('MIGRATION_TIME_RESERVE', 120))
+
+
+class MigrationsIncomplete(Exception):
+    pass
+
+
+def backfill_in_batches(engine, table, set_clause, batch_size=None):
+    """Runs ``UPDATE <table> SET <set_clause>`` over ranges of ``id`` values,
+    committing after each batch.
+    """
+    batch_size = batch_size or MIGRATION_BATCH_SIZE
+
+    with engine.connect() as conn:
+        low, high = conn.execute(
+            f'SELECT MIN(id), MAX(id) FROM {table}').fetchone()
+
+    if low is None:
+        return
+
+    for start in range(low, high + 1, batch_size):
+        with engine.begin() as conn:
+            conn.execute(
+                f'UPDATE {table} SET {set_clause} '
+                f'WHERE id >= {start} AND id < {start + batch_size}'
+            )
+
+
+def migrate_card_bitmasks(engine):
+    """Moves the legacy ``have_N``/``need_N`` Boolean columns on
+    ``slack_users`` into the ``have_cards``/``need_cards`` bitmask columns.
+
+    Missing bitmask columns are added, backfilled from the Boolean columns in
+    batches and the Boolean columns are then dropped.
+    """
+    columns = [c['name'] for c in inspect(engine).get_columns('slack_users')]
+
+    for type_ in ('have', 'need'):
+        mask_column = f'{type_}_cards'
+        if mask_column not in columns:
+            logger.info(f'Adding column slack_users.{mask_column}...')
+            with engine.begin() as conn:
+                conn.execute(
+                    f'ALTER TABLE slack_users ADD COLUMN {mask_column} '
+                    f'INTEGER NOT NULL DEFAULT 0'
+                )
+
+        legacy_columns = [
+            f'{type_}_{i}' for i in range(1, CARD_COUNT + 1)
+            if f'{type_}_{i}' in columns
+        ]
+        if not legacy_columns:
+            continue
+
+        logger.info(f'Backfilling slack_users.{mask_column}...')
+        bits = ' | '.join(
+            f"(IF({c}, 1, 0) << {int(c.split('_')[-1]) - 1})"
+            for c in legacy_columns
+        )
+        backfill_in_batches(engine, 'slack_users', f'{mask_column} = {bits}')
+
+        logger.info(f'Dropping legacy {type_}_N columns...')
+        with engine.begin() as conn:
+            conn.execute(
+                'ALTER TABLE slack_users ' +
+                ', '.join(f'DROP COLUMN {c}' for c in legacy_columns)
+            )
+
+
+def add_unique_user_key(engine):
+    """Replaces the ``(slack_team_id, user_id)`` index on ``slack_users`` with
+    a unique key. Duplicate users created by concurrent first messages are
+    merged into the oldest row first, combining their cards.
+    """
+    inspector = inspect(engine)
+    unique_keys = [
+        c['name'] for c in inspector.get_unique_constraints('slack_users')]
+    indexes = [i['name'] for i in inspector.get_indexes('slack_users')]
+
+    with engine.begin() as conn:
+        if 'uq_slack_users_team_user' not in unique_keys:
+            logger.info('Merging duplicate Slack users...')
+            conn.execute(
+                'UPDATE slack_users u JOIN ('
+                'SELECT MIN(id) AS id, BIT_OR(have_cards) AS have_cards, '
+                'BIT_OR(need_cards) AS need_cards FROM slack_users '
+                'GROUP BY slack_team_id, user_id HAVING COUNT(*) > 1'
+                ') d ON u.id = d.id '
+                'SET u.have_cards = d.have_cards, u.need_cards = d.need_cards'
+            )
+            conn.execute(
+                'DELETE u FROM slack_users u JOIN slack_users k '
+                'ON u.slack_team_id = k.slack_team_id '
+                'AND u.user_id = k.user_id AND u.id > k.id'
+            )
+
+            logger.info('Adding unique key uq_slack_users_team_user...')
+            conn.execute(
+                'ALTER TABLE slack_users ADD CONSTRAINT uq_slack_users_team_user '
+                'UNIQUE (slack_team_id, user_id)'
+            )
+
+        if 'ix_slack_users_team_user' in indexes:
+            logger.info('Dropping index ix_slack_users_team_user...')
+            conn.execute(
+                'ALTER TABLE slack_users DROP INDEX ix_slack_users_team_user')
+
+
+def create_index(engine, table, name, columns):
+    """Creates the named index unless the table already has it. Migrations
+    spell out their DDL rather than reading the models, which describe the
+    latest schema and not the one the migration runs against.
+    """
+    existing = [i['name'] for i in inspect(engine).get_indexes(table)]
+    if name in existing:
+        return
+
+    logger.info(f'Creating index {name} on {table}...')
+    with engine.begin() as conn:
+        conn.execute(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+
+
+def create_trade_plan_indexes(engine):
+    """``create_all`` only creates indexes alongside new tables, so the
+    ``trade_plans`` lookup indexes are created here when the table already
+    existed.
+    """
+    create_index(engine, 'trade_plans', 'ix_trade_plans_team_giver',
+                 ['slack_team_id', 'giver_user_id'])
+    create_index(engine, 'trade_plans', 'ix_trade_plans_team_receiver',
+                 ['slack_team_id', 'receiver_user_id'])
+
+
+def add_team_cards_version(engine):
+    """Adds the ``cards_version`` counter that invalidates cached trade
+    results on ``slack_teams``.
+    """
+    columns = [c['name'] for c in inspect(engine).get_columns('slack_teams')]
+
+    if 'cards_version' not in columns:
+        logger.info('Adding column slack_teams.cards_version...')
+        with engine.begin() as conn:
+            conn.execute(
+                'ALTER TABLE slack_teams ADD COLUMN cards_version '
+                'INTEGER NOT NULL DEFAULT 0'
+            )
+
+
+def add_user_notify(engine):
+    """Adds the ``notify`` opt-in flag on ``slack_users`` and the index used
+    to find the team members who opted in.
+    """
+    columns = [c['name'] for c in inspect(engine).get_columns('slack_users')]
+
+    if 'notify' not in columns:
+        logger.info('Adding column slack_users.notify...')
+        with engine.begin() as conn:
+            conn.execute(
+                'ALTER TABLE slack_users ADD COLUMN notify '
+                'BOOLEAN NOT NULL DEFAULT 0'
+            )
+
+    create_index(engine, 'slack_users', 'ix_slack_users_team_notify',
+                 ['slack_team_id', 'notify'])
+
+
+def add_notify_cards_index(engine):
+    """Creates the ``notify_cards`` reverse index and fills it from the cards
+    of the members who already opted in to notifications.
+    """
+    if 'notify_cards' not in inspect(engine).get_table_names():
+        logger.info('Creating table notify_cards...')
+        with engine.begin() as conn:
+            conn.execute(
+                'CREATE TABLE notify_cards ('
+                'slack_team_id INTEGER NOT NULL, '
+                'card_type VARCHAR(4) NOT NULL, '
+                'card INTEGER NOT NULL, '
+                'slack_user_id INTEGER NOT NULL, '
+                'PRIMARY KEY (slack_team_id, card_type, card, slack_user_id), '
+                'INDEX ix_notify_cards_user (slack_user_id), '
+                'FOREIGN KEY (slack_team_id) REFERENCES slack_teams (id), '
+                'FOREIGN KEY (slack_user_id) REFERENCES slack_users (id))'
+            )
+
+    for type_ in ('have', 'need'):
+        logger.info(f'Indexing the {type_} cards of opted-in members...')
+        with engine.begin() as conn:
+            for card in range(1, CARD_COUNT + 1):
+                conn.execute(
+                    f"INSERT IGNORE INTO notify_cards "
+                    f"(slack_team_id, card_type, card, slack_user_id) "
+                    f"SELECT slack_team_id, '{type_}', {card}, id "
+                    f"FROM slack_users WHERE notify = 1 "
+                    f"AND {type_}_cards & {1 << (card - 1)} != 0"
+                )
+
+
+# Ordered (version, description, function) tuples. Append new migrations
+# with the next version number and never renumber existing ones. Each
+# migration checks the current schema first, so it can safely run on a
+# database that already has the change.
+MIGRATIONS = [
+    (1, 'Store card have/need state as bitmasks', migrate_card_bitmasks),
+    (2, 'Unique (slack_team_id, user_id) key', add_unique_user_key),
+    (3, 'Trade plan lookup indexes', create_trade_plan_indexes),
+    (4, 'Team cards version counter', add_team_cards_version),
+    (5, 'Trade match notification opt-in', add_user_notify),
+    (6, 'Notification card reverse index', add_notify_cards_index)
+]
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def applied_versions(engine):
+    with engine.connect() as conn:
+        return {
+            row.version for row in
+            conn.execute(SchemaMigrations.__table__.select())
+        }
+
+
+def record_migration(engine, version, description):
+    with engine.begin() as conn:
+        conn.execute(
+            SchemaMigrations.__table__.insert().values(
+                version=version, description=description)
+        )
+
+
+def mark_applied(engine, target_version):
+    """Records the migrations up to ``target_version`` as applied without
+    running them, for a database that ``create_all`` just built from the
+    current models.
+    """
+    applied = applied_versions(engine)
+
+    for version, description, _ in MIGRATIONS:
+        if version <= target_version and version not in applied:
+            record_migration(engine, version, description)
+
+
+def run_migrations(engine, target_version, time_left=None):
+    """Applies the migrations that have not run yet, in order, up to and
+    including ``target_version``. Each one is recorded in
+    ``schema_migrations`` as soon as it finishes, so a failed run continues
+    where it stopped the next time.
+
+    :param time_left: Returns the milliseconds left in the invocation, e.g.
+        ``context.get_remaining_time_in_millis``. No migration is started
+        with less than ``MIGRATION_TIME_RESERVE`` seconds left.
+
+    :raises MigrationsIncomplete: Migrations were stopped for lack of time
+
+    :returns: The highest applied version
+    :rtype: int
+    """
+    applied = applied_versions(engine)
+
+    for version, description, migration in MIGRATIONS:
+        if version > target_version:
+            break
+
+        if version in applied:
+            continue
+
+        if time_left and time_left() < MIGRATION_TIME_RESERVE * 1000:
+            raise MigrationsIncomplete(
+                f'Stopped before migration {version} with '
+                f'{time_left() // 1000} seconds left, deploy again to '
+                f'continue'
+            )
+
+        logger.info(f'Applying migration {version}: {description}')
+        migration(engine)
+        record_migration(engine, version, description)
+
+    with engine.connect() as conn:
+        return conn.execute(
+            func.max(SchemaMigrations.version).select()).scalar() or 0
@@ -1,10 +1,11 @@
+import gzip
 import json
 import logging
 import os
+from datetime import datetime
 
-from sqlalchemy import create_engine
-
-from models import Session, SlackTeams, SlackUsers
+from jtg.database import get_session
+from jtg.models import SlackTeams, SlackUsers, TradePlans
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -13,23 +14,103 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 DOMAIN_NAME = os.getenv('DOMAIN_NAME')
 
-DATABASE_ENDPOINT = os.getenv('DATABASE_ENDPOINT')
-DATABASE_PORT = os.getenv('DATABASE_PORT')
-DATABASE_USERNAME = os.getenv('DATABASE_USERNAME')
-DATABASE_PASSWORD = os.getenv('DATABASE_PASSWORD')
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 500))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 5000))
+YIELD_PER = int(os.getenv('YIELD_PER', 1000))
+
+# Exports are written to EXPORT_BUCKET when set, otherwise to EXPORT_PATH.
+EXPORT_BUCKET = os.getenv('EXPORT_BUCKET')
+EXPORT_PATH = os.getenv('EXPORT_PATH', '/tmp')
+
+TABLES = {
+    'teams': SlackTeams,
+    'users': SlackUsers,
+    'plans': TradePlans
+}
+
+# Columns that can be projected with ``fields``. They match what each
+# model's ``serialize()`` returns, so tokens are never exposed.
+FIELDS = {
+    SlackTeams: ('id', 'team_id', 'team_name', 'bot_user_id'),
+    SlackUsers: (
+        'id', 'user_id', 'slack_team_id', 'notify', 'have_cards', 'need_cards'
+    ),
+    TradePlans: (
+        'id', 'slack_team_id', 'giver_user_id', 'receiver_user_id', 'card',
+        'swap_id', 'created_at'
+    )
+}
+
+
+class RequestError(Exception):
+    pass
+
+
+def to_json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def get_columns(table, fields):
+    """Returns the columns to select for a comma separated ``fields`` value,
+    or None to return whole serialized rows.
+
+    :raises RequestError: A field isn't one of the table's ``FIELDS``
+    """
+    if not fields:
+        return None
+
+    columns = table.__table__.columns
+    names = [f.strip() for f in fields.split(',') if f.strip()]
+
+    unknown = [n for n in names if n not in FIELDS[table]]
+    if unknown:
+        raise RequestError(f"Unknown fields: {', '.join(unknown)}")
+
+    # The id is always selected as it is the pagination cursor.
+    if 'id' not in names:
+        names.insert(0, 'id')
+
+    return [columns[n] for n in names]
+
+
+def iter_rows(session, table, columns=None, cursor=None, limit=None):
+    """Yields rows of a table as dictionaries in ``id`` order, streaming them
+    from the database ``YIELD_PER`` at a time.
 
-engine = create_engine(
-    f'mysql+pymysql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@'
-    f'{DATABASE_ENDPOINT}:{DATABASE_PORT}/jamfthegathering?charset=utf8'
-)
-Session.configure(bind=engine)
+    :param table: Model class to read
+    :param list columns: Columns to project, or None for ``serialize()``
+    :param int cursor: Only return rows with an ``id`` after this value
+    :param int limit: Maximum number of rows to return
+    """
+    query = session.query(*columns) if columns else session.query(table)
+
+    if cursor is not None:
+        query = query.filter(table.id > cursor)
+
+    query = query.order_by(table.id)
 
+    if limit is not None:
+        query = query.limit(limit)
 
-def query_table(table):
-    session = Session()
+    for row in query.yield_per(YIELD_PER):
+        if columns:
+            yield {c.name: to_json_value(v) for c, v in zip(columns, row)}
+        else:
+            yield row.serialize()
+
+
+def query_table(table, fields=None, cursor=None, limit=PAGE_SIZE):
+    """Returns a page of rows and the cursor for the next page, which is None
+    on the last page.
+
+    :rtype: tuple
+    """
+    columns = get_columns(table, fields)
+    session = get_session(read_only=True)
 
     try:
-        results = session.query(table).all()
+        # Reading one extra row tells us if there is another page.
+        rows = list(iter_rows(session, table, columns, cursor, limit + 1))
     except:
         logger.exception(f'Unable to read {table} from database')
         session.rollback()
@@ -37,7 +118,59 @@ def query_table(table):
     finally:
         session.close()
 
-    return [i.serialize() for i in results]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1]['id']
+
+    return rows, None
+
+
+def write_export(table, name, fields=None):
+    """Writes a whole table as gzip compressed NDJSON, one row per line, and
+    returns where it was written and the row count.
+
+    :rtype: tuple
+    """
+    columns = get_columns(table, fields)
+    filename = f"{name}-{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}" \
+               f".ndjson.gz"
+    path = os.path.join(EXPORT_PATH, filename)
+    count = 0
+
+    session = get_session(read_only=True)
+    try:
+        with gzip.open(path, 'wt') as f:
+            for row in iter_rows(session, table, columns):
+                f.write(json.dumps(row))
+                f.write('\n')
+                count += 1
+    except:
+        logger.exception(f'Unable to export {table}')
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    if EXPORT_BUCKET:
+        import boto3
+
+        key = f'exports/{filename}'
+        boto3.client('s3').upload_file(path, EXPORT_BUCKET, key)
+        os.remove(path)
+        return f's3://{EXPORT_BUCKET}/{key}', count
+
+    return path, count
+
+
+def get_int(params, name, default=None):
+    value = params.get(name)
+    if value is None or value == '':
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise RequestError(f'{name} must be an integer')
 
 
 def response(message, status_code):
@@ -63,10 +196,57 @@ def response(message, status_code):
 
 
 def lambda_handler(event, context):
+    """Query string parameters:
+
+    * ``table``: ``teams``, ``users`` or ``plans`` (default: teams and users)
+    * ``cursor``: The ``NextCursor`` of the previous page
+    * ``limit``: Rows per page, up to ``MAX_PAGE_SIZE``
+    * ``fields``: Comma separated columns to return instead of whole rows
+    * ``export``: ``1`` to write whole tables as gzipped NDJSON instead
+    """
+    params = event.get('queryStringParameters') or dict()
+
     try:
-        teams = query_table(SlackTeams)
-        users = query_table(SlackUsers)
+        names = [params['table']] if params.get('table') else \
+            ['teams', 'users']
+        for name in names:
+            if name not in TABLES:
+                raise RequestError(f'Unknown table: {name}')
+
+        fields = params.get('fields')
+        cursor = get_int(params, 'cursor')
+        limit = min(get_int(params, 'limit', PAGE_SIZE), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise RequestError('limit must be at least 1')
+
+        if cursor is not None and len(names) > 1:
+            raise RequestError('cursor requires a table')
+
+        if params.get('export') == '1':
+            exports = dict()
+            for name in names:
+                location, count = write_export(TABLES[name], name, fields)
+                exports[name] = {'Location': location, 'Rows': count}
+
+            return response({'Exports': exports}, 200)
+
+        if len(names) == 1:
+            rows, next_cursor = query_table(
+                TABLES[names[0]], fields, cursor, limit)
+            return response({'Items': rows, 'NextCursor': next_cursor}, 200)
+
+        teams, teams_cursor = query_table(SlackTeams, fields, limit=limit)
+        users, users_cursor = query_table(SlackUsers, fields, limit=limit)
+    except RequestError as error:
+        return response(str(error), 400)
     except:
         return response('failed', 500)
 
-    return response({'Teams': teams, 'Users': users}, 200)
+    return response(
+        {
+            'Teams': teams,
+            'Users': users,
+            'NextCursors': {'Teams': teams_cursor, 'Users': users_cursor}
+        },
+        200
+    )
@@ -1,15 +1,61 @@
 import json
 import logging
 import os
+import time
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from jtg.idempotency import IdempotencyStore
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 EVENTS_TOPIC = os.getenv('EVENTS_TOPIC')
 
+# Slack retries events that aren't acknowledged within 3 seconds, so SNS
+# calls get short timeouts and a single retry.
+SNS_CONNECT_TIMEOUT = float(os.getenv('SNS_CONNECT_TIMEOUT', 1))
+SNS_READ_TIMEOUT = float(os.getenv('SNS_READ_TIMEOUT', 1))
+SNS_MAX_ATTEMPTS = int(os.getenv('SNS_MAX_ATTEMPTS', 2))
+
+SNS_MAX_MESSAGE_BYTES = 256 * 1024
+
+# The parts of a Slack event the user_events function uses
+EVENT_FIELDS = ('type', 'subtype', 'user', 'text', 'channel', 'ts')
+
+sns_client = None
+publish_hooks = list()
+
+events_seen = IdempotencyStore('api')
+
+
+def get_sns_client():
+    """Returns the SNS client, creating it on first use so warm invocations
+    reuse the client and its connections.
+    """
+    global sns_client
+
+    if sns_client is None:
+        sns_client = boto3.client(
+            'sns',
+            config=Config(
+                connect_timeout=SNS_CONNECT_TIMEOUT,
+                read_timeout=SNS_READ_TIMEOUT,
+                retries={'max_attempts': SNS_MAX_ATTEMPTS}
+            )
+        )
+
+    return sns_client
+
+
+def add_publish_hook(func):
+    """Registers a function that is called after each publish as
+    ``func(elapsed_ms, success)``.
+    """
+    publish_hooks.append(func)
+
 
 def response(message, status_code):
     """Returns a dictionary object for an API Gateway Lambda integration
@@ -33,18 +79,102 @@ def response(message, status_code):
     }
 
 
-def process_event(data):
-    sns_client = boto3.client('sns')
-    logger.info('Sending Slack event to be processed...')
+def encode_message(data):
+    """Encodes a Slack event callback as an SNS message with only the fields
+    user_events reads.
+
+    :returns: The message, or None if it is over the SNS size limit
+    :rtype: str
+    """
+    message = json.dumps({
+        'team_id': data['team_id'],
+        'event_id': data.get('event_id'),
+        'event_time': data.get('event_time'),
+        'event': {
+            k: data['event'][k] for k in EVENT_FIELDS if k in data['event']
+        }
+    })
+
+    size = len(message.encode())
+    if size > SNS_MAX_MESSAGE_BYTES:
+        logger.error(
+            f"Event {data.get('event_id')} is {size} bytes, over the SNS "
+            f"limit of {SNS_MAX_MESSAGE_BYTES}")
+        return None
+
+    return message
+
+
+def publish_message(message):
+    """Publishes a message to the events topic.
+
+    API Gateway invokes the function with one Slack event per request, so
+    there is never more than one message to publish and PublishBatch would
+    add nothing.
+
+    :returns: Whether the message was published
+    :rtype: bool
+    """
+    started = time.perf_counter()
 
     try:
-        sns_client.publish(
+        get_sns_client().publish(
             TopicArn=EVENTS_TOPIC,
-            Message=json.dumps(data),
+            Message=message,
             MessageStructure='string'
         )
-    except ClientError as error:
+        success = True
+    except (BotoCoreError, ClientError) as error:
         logger.exception(f'Error sending SNS notification: {error}')
+        success = False
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(f'Published event in {elapsed_ms:.1f} ms')
+
+    for hook in publish_hooks:
+        hook(elapsed_ms, success)
+
+    return success
+
+
+def get_header(event, name):
+    headers = event.get('headers') or dict()
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+
+    return None
+
+
+def is_duplicate(event, body):
+    """Slack redelivers events that weren't acknowledged in time, marking
+    them with the ``X-Slack-Retry-Num`` header. Deliveries of an
+    ``event_id`` that was already accepted are dropped.
+    """
+    if events_seen.claim(body.get('event_id')):
+        return False
+
+    logger.info(
+        f"Dropping duplicate event {body.get('event_id')} "
+        f"(retry {get_header(event, 'X-Slack-Retry-Num')}, "
+        f"reason {get_header(event, 'X-Slack-Retry-Reason')})")
+    return True
+
+
+def process_event(data):
+    """Sends a Slack event to be processed.
+
+    :returns: False if the event couldn't be published and Slack should
+        retry it
+    :rtype: bool
+    """
+    message = encode_message(data)
+    if not message:
+        # Too large to ever publish, so a retry wouldn't help.
+        return True
+
+    logger.info('Sending Slack event to be processed...')
+    return publish_message(message)
 
 
 def lambda_handler(event, context):
@@ -68,8 +198,21 @@ def lambda_handler(event, context):
             logger.info('Ignoring bot message...')
             return response('OK', 200)
 
+        elif body['event'].get('subtype'):
+            # Edits, deletions, joins and the like aren't commands.
+            logger.info(f"Ignoring '{body['event']['subtype']}' message...")
+            return response('OK', 200)
+
         if body['event']['type'] in ('app_mention', 'message'):
-            process_event(body)
+            if is_duplicate(event, body):
+                return response('OK', 200)
+
+            if not process_event(body):
+                # Slack retries 5xx responses, so the event is released for
+                # the retry to be accepted.
+                events_seen.release(body.get('event_id'))
+                return response('Unable to accept the event', 503)
+
             return response('Accepted', 202)
 
     logger.warning('Bad Request')
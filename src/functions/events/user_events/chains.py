@@ -0,0 +1,102 @@
+import time
+from collections import defaultdict, namedtuple
+
+from jtg.models import mask_to_cards
+
+Member = namedtuple('Member', ['user_id', 'have_cards', 'need_cards'])
+TradeStep = namedtuple('TradeStep', ['giver', 'receiver', 'card'])
+
+
+class TeamGraph(object):
+    """The directed have -> need graph of a team. There is an edge from A to
+    B when A has a card that B needs.
+    """
+    def __init__(self, members):
+        self.members = [Member(*m) for m in members]
+        self.index = {m.user_id: i for i, m in enumerate(self.members)}
+
+        self.needers = defaultdict(list)
+        for i, member in enumerate(self.members):
+            for card in mask_to_cards(member.need_cards):
+                self.needers[card].append(i)
+
+    def edges(self, i):
+        """Yields ``(j, card)`` for each member ``j`` that member ``i`` can
+        give a card to, using the lowest numbered card that fits.
+        """
+        seen = set()
+        for card in mask_to_cards(self.members[i].have_cards):
+            for j in self.needers[card]:
+                if j != i and j not in seen:
+                    seen.add(j)
+                    yield j, card
+
+
+def find_trade_cycles(user_id, members, lengths=(3, 4), limit=5,
+                      time_budget=1.0):
+    """Finds trade cycles that start and end with the given user, shortest
+    first. The search stops after ``limit`` cycles or once ``time_budget``
+    seconds have passed, so it returns whatever was found up to that point.
+
+    :param str user_id: The requesting Slack user ID
+    :param members: Iterable of ``(user_id, have_cards, need_cards)`` for the
+        team, including the requesting user
+    :param tuple lengths: Cycle lengths to search for
+    :param int limit: Maximum number of cycles to return
+    :param float time_budget: Maximum search time in seconds
+
+    :returns: Cycles as lists of ``TradeStep``
+    :rtype: list
+    """
+    graph = TeamGraph(members)
+    if user_id not in graph.index:
+        return list()
+
+    start = graph.index[user_id]
+    start_needs = graph.members[start].need_cards
+    deadline = time.monotonic() + time_budget
+    cycles = list()
+
+    def closing_card(i):
+        overlap = graph.members[i].have_cards & start_needs
+        return mask_to_cards(overlap)[0] if overlap else None
+
+    def search(path, steps, length):
+        if len(cycles) >= limit or time.monotonic() > deadline:
+            return
+
+        current = path[-1]
+
+        if len(path) == length:
+            card = closing_card(current)
+            if card:
+                cycles.append(steps + [TradeStep(
+                    graph.members[current].user_id, user_id, card)])
+            return
+
+        for j, card in graph.edges(current):
+            if j in path:
+                continue
+
+            # The last member before closing the loop must have a card the
+            # requesting user needs.
+            if len(path) == length - 1 and closing_card(j) is None:
+                continue
+
+            search(
+                path + [j],
+                steps + [TradeStep(
+                    graph.members[current].user_id,
+                    graph.members[j].user_id,
+                    card
+                )],
+                length
+            )
+
+            if len(cycles) >= limit or time.monotonic() > deadline:
+                return
+
+    for length in lengths:
+        search([start], list(), length)
+
+    return cycles
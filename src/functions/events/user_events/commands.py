@@ -0,0 +1,107 @@
+import re
+
+from jtg.models import CARD_COUNT
+
+# 'show trade chains' comes before 'show trades' so the alternation tries the
+# longer name first. Like the original startswith() checks, anything after
+# the command name is treated as its arguments.
+COMMAND_RE = re.compile(
+    r'(help|i have|i need|i traded|show trade chains|show trades|'
+    r'show plan|show mine|notify|more)(.*)',
+    re.DOTALL
+)
+TRADED_SPLIT_RE = re.compile(r'\s+for\s+')
+
+# A card number, a range of card numbers or 'all'. re.ASCII keeps \d to the
+# digits 0-9, which int() can always parse.
+CARD_TOKEN_RE = re.compile(r'(\d+)(?:-(\d+))?|all', re.ASCII)
+
+ALL_CARD_NUMBERS = range(1, CARD_COUNT + 1)
+
+
+class CommandException(Exception):
+    pass
+
+
+def parse_card_list(string):
+    """Parses a list of card numbers such as ``1 2 3``, ``1, 2, 3``,
+    ``1-6 9`` or ``all`` into sorted, unique card numbers. Numbers outside
+    of the card range are passed through so the caller can drop them.
+
+    :raises CommandException: The list is empty or has an invalid token
+
+    :rtype: list
+    """
+    cards = set()
+
+    for token in string.replace(',', ' ').split():
+        match = CARD_TOKEN_RE.fullmatch(token)
+        if not match:
+            raise CommandException(f'Invalid card: {token}')
+
+        start, end = match.groups()
+        if start is None:
+            cards.update(ALL_CARD_NUMBERS)
+
+        elif end is None:
+            cards.add(int(start))
+
+        else:
+            low, high = sorted((int(start), int(end)))
+            cards.update(range(max(low, 1), min(high, CARD_COUNT) + 1))
+
+    if not cards:
+        raise CommandException('No cards were given')
+
+    return sorted(cards)
+
+
+def parse_cards_args(string):
+    return parse_card_list(string),
+
+
+def parse_traded_args(string):
+    trade_out, sep, trade_in = string.partition(' for ')
+    if not sep:
+        parts = TRADED_SPLIT_RE.split(string, maxsplit=1)
+        if len(parts) != 2:
+            raise CommandException("Expected '<cards> for <cards>'")
+
+        trade_out, trade_in = parts
+
+    return parse_card_list(trade_out), parse_card_list(trade_in)
+
+
+def parse_notify_args(string):
+    setting = string.strip()
+    if setting not in ('on', 'off'):
+        raise CommandException("Expected 'on' or 'off'")
+
+    return setting == 'on',
+
+
+ARGUMENT_PARSERS = {
+    'i have': parse_cards_args,
+    'i need': parse_cards_args,
+    'i traded': parse_traded_args,
+    'notify': parse_notify_args
+}
+
+
+def parse_command(input_text):
+    """Parses a message in a single pass.
+
+    :returns: The command name and a tuple of parsed arguments, or
+        ``(None, ())`` if the message isn't a known command
+    :rtype: tuple
+
+    :raises CommandException: The command's arguments are invalid
+    """
+    match = COMMAND_RE.match(input_text.strip())
+    if not match:
+        return None, ()
+
+    name, args = match.groups()
+    parser = ARGUMENT_PARSERS.get(name)
+
+    return name, parser(args) if parser else ()
@@ -0,0 +1,73 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = bool(int(os.getenv('METRICS_ENABLED', 1)))
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'JamfTheGathering')
+
+# Dimension sets each metric is published under
+DIMENSIONS = [['Command'], ['Team', 'Command']]
+
+
+class StageTimer(object):
+    """Collects the time spent in each stage of handling one Slack event and
+    writes them as a CloudWatch Embedded Metric Format log line.
+    """
+    def __init__(self, **dimensions):
+        self.start = time.perf_counter()
+        self.dimensions = dimensions
+        self.timings = dict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def add(self, name, elapsed_ms):
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed_ms
+
+    def copy(self, **dimensions):
+        """Returns a timer that starts with this one's start time, timings
+        and dimensions, for stages shared by a batch of events.
+        """
+        timer = StageTimer(**dict(self.dimensions, **dimensions))
+        timer.start = self.start
+        timer.timings = dict(self.timings)
+        return timer
+
+    def to_emf(self):
+        metrics = dict(self.timings)
+        metrics['Total'] = (time.perf_counter() - self.start) * 1000
+
+        dimensions = {
+            'Command': 'none',
+            'Team': 'unknown'
+        }
+        dimensions.update(self.dimensions)
+
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': DIMENSIONS,
+                    'Metrics': [
+                        {'Name': name, 'Unit': 'Milliseconds'}
+                        for name in metrics
+                    ]
+                }]
+            }
+        }
+        line.update(dimensions)
+        line.update({k: round(v, 3) for k, v in metrics.items()})
+        return line
+
+    def emit(self):
+        # EMF lines must be written as-is, without the logging prefix the
+        # Lambda runtime adds to log records.
+        if METRICS_ENABLED:
+            print(json.dumps(self.to_emf()), flush=True)
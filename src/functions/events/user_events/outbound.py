@@ -0,0 +1,192 @@
+import logging
+import time
+from collections import OrderedDict, namedtuple
+
+from jtg.cache import TTLCache
+
+logger = logging.getLogger()
+
+OutboundMessage = namedtuple(
+    'OutboundMessage',
+    ['channel', 'text', 'token', 'team_id', 'timer', 'blocks']
+)
+
+
+class TokenBucket(object):
+    """Allows ``rate`` messages per second with bursts of up to ``capacity``.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """Whether a message can be sent now."""
+        self.refill()
+        return self.tokens >= 1
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+    def penalize(self, seconds):
+        """Holds the bucket empty for ``seconds``, e.g. after Slack reports
+        the channel as rate limited.
+        """
+        self.refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class OutboundScheduler(object):
+    """Queues replies and sends them in per-channel turns.
+
+    Replies to the same channel that are queued before a flush are coalesced
+    into as few messages as ``max_chars`` allows. A flush covers one
+    invocation, so this only happens with the SQS source, whose invocations
+    carry a batch of events. SNS invokes the function with a single event,
+    and replies aren't held over for a later invocation because a frozen or
+    recycled container would lose them.
+
+    Each ``(channel, token)`` pair has a token bucket that persists across
+    warm invocations, but a flush never sleeps waiting for it. A channel
+    over its rate still gets its replies, which are counted as
+    ``over_limit``, and Slack's own ``Retry-After`` handling in the API
+    client is the backstop.
+
+    :param send: ``send(channel, text, token, team_id, blocks)`` returning
+        the Slack API response, or None if the request failed
+    """
+    def __init__(self, send, rate=1.0, burst=2, max_chars=4000,
+                 max_queue=500):
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        self.max_chars = max_chars
+        self.max_queue = max_queue
+        self.buckets = TTLCache(maxsize=1024, ttl=max(60, burst / rate))
+        self.queue = list()
+        self.stats = {
+            'queued': 0,
+            'peak_depth': 0,
+            'sent': 0,
+            'coalesced': 0,
+            'over_limit': 0,
+            'failed': 0,
+            'dropped': 0
+        }
+
+    def get_bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+
+        # Refreshes the entry's expiry while the channel is in use.
+        self.buckets.set(key, bucket)
+        return bucket
+
+    def enqueue(self, channel, text, token, team_id=None, timer=None):
+        """Queues a reply. Block Kit blocks are taken from ``text.blocks``
+        when it has them.
+        """
+        if len(self.queue) >= self.max_queue:
+            logger.warning(
+                f'Outbound queue is full, dropping reply to {channel}')
+            self.stats['dropped'] += 1
+            return
+
+        self.queue.append(OutboundMessage(
+            channel, text, token, team_id, timer,
+            getattr(text, 'blocks', None)
+        ))
+        self.stats['queued'] += 1
+        self.stats['peak_depth'] = max(
+            self.stats['peak_depth'], len(self.queue))
+
+    def coalesce(self, messages):
+        """Joins messages for one channel into chunks of up to ``max_chars``
+        characters, keeping their order. Messages with blocks are always
+        sent on their own.
+
+        :returns: ``(text, messages)`` for each chunk
+        :rtype: list
+        """
+        chunks = list()
+
+        for message in messages:
+            if chunks and not message.blocks and \
+                    not chunks[-1][1][-1].blocks and \
+                    len(chunks[-1][0]) + len(message.text) + 2 <= \
+                    self.max_chars:
+                text, parts = chunks[-1]
+                chunks[-1] = (
+                    f'{text.rstrip()}\n\n{message.text}', parts + [message])
+                self.stats['coalesced'] += 1
+            else:
+                chunks.append((message.text, [message]))
+
+        return chunks
+
+    def deliver(self, key, text, messages):
+        """Sends one chunk of coalesced replies."""
+        channel, token = key
+        bucket = self.get_bucket(key)
+        if not bucket.available():
+            self.stats['over_limit'] += len(messages)
+        bucket.take()
+
+        start = time.perf_counter()
+        data = self.send(
+            channel, text, token, messages[0].team_id, messages[0].blocks)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        for message in messages:
+            if message.timer:
+                message.timer.add('SlackPost', elapsed_ms)
+
+        if data and data.get('ok'):
+            self.stats['sent'] += len(messages)
+            return
+
+        # A failed request (None) is usually a 429 whose Retry-After was
+        # too long for the Slack API client to wait. The bucket is held
+        # empty so later replies to the channel are counted against it.
+        if data is None or data.get('error') == 'ratelimited':
+            bucket.penalize(1 / self.rate)
+
+        logger.error(f'Unable to deliver a reply to {channel}')
+        self.stats['failed'] += len(messages)
+
+    def flush(self):
+        """Sends everything in the queue without waiting for rate limits,
+        taking one chunk from each channel in turn so a busy channel doesn't
+        hold up the rest.
+
+        :returns: The scheduler statistics
+        :rtype: dict
+        """
+        grouped = OrderedDict()
+        for message in self.queue:
+            grouped.setdefault(
+                (message.channel, message.token), list()).append(message)
+        self.queue = list()
+
+        pending = OrderedDict(
+            (key, self.coalesce(items)) for key, items in grouped.items())
+
+        while pending:
+            for key in list(pending):
+                text, parts = pending[key].pop(0)
+                self.deliver(key, text, parts)
+
+                if not pending[key]:
+                    del pending[key]
+
+        logger.info(f'Outbound replies: {self.stats}')
+        return dict(self.stats)
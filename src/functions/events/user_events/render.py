@@ -0,0 +1,112 @@
+from itertools import islice
+
+from jtg.models import mask_to_cards
+
+# Slack allows at most 50 blocks in a message.
+MAX_BLOCKS = 50
+
+
+class Reply(str):
+    """Reply text that also carries Block Kit ``blocks``. The text is used
+    as the notification and fallback text.
+    """
+    def __new__(cls, text, blocks=None):
+        reply = super(Reply, cls).__new__(cls, text)
+        reply.blocks = blocks
+        return reply
+
+    def __radd__(self, other):
+        # Keeps the blocks when a mention is put in front of the text.
+        return Reply(other + str(self), self.blocks)
+
+
+def format_trade(match):
+    """Formats one ranked ``TradeMatch`` as a line of the reply."""
+    parts = list()
+    if match.has_cards:
+        parts.append(
+            f"has {', '.join(str(i) for i in mask_to_cards(match.has_cards))}")
+    if match.needs_cards:
+        parts.append(
+            f"needs "
+            f"{', '.join(str(i) for i in mask_to_cards(match.needs_cards))}")
+
+    return f"<@{match.user_id}> {' and '.join(parts)}"
+
+
+def trade_lines(matches, start=0):
+    """Lazily formats ranked matches from ``start``, so only the lines that
+    fit on a page are ever built.
+    """
+    return (format_trade(m) for m in islice(matches, start, None))
+
+
+def take_page(lines, max_items, max_bytes):
+    """Takes lines until ``max_items`` lines or ``max_bytes`` bytes of text.
+    The first line is always taken.
+
+    :returns: The lines of the page
+    :rtype: list
+    """
+    page = list()
+    size = 0
+
+    for line in lines:
+        line_size = len(line.encode()) + 1
+        if page and size + line_size > max_bytes:
+            break
+
+        page.append(line)
+        size += line_size
+
+        if len(page) >= max_items:
+            break
+
+    return page
+
+
+def render_trades(matches, start=0, max_items=25, max_bytes=3000,
+                  blocks=False):
+    """Renders a page of ranked matches.
+
+    :param list matches: Ranked ``TradeMatch`` tuples
+    :param int start: Index of the first match on the page
+    :param int max_items: Maximum matches on the page
+    :param int max_bytes: Budget for the matches' text on the page
+    :param bool blocks: Include Block Kit blocks in the reply
+
+    :returns: The reply and the index of the next page's first match, or
+        None if this is the last page
+    :rtype: tuple
+    """
+    max_items = min(max_items, MAX_BLOCKS - 2) if blocks else max_items
+    page = take_page(trade_lines(matches, start), max_items, max_bytes)
+    next_start = start + len(page)
+
+    header = 'Here are the available trades for you:' if start == 0 else \
+        'Here are more trades for you:'
+    footer = None
+    if next_start < len(matches):
+        footer = f"Showing {start + 1}-{next_start} of {len(matches)}. " \
+                 f"Type 'more' to see the next ones."
+    else:
+        next_start = None
+
+    text = '\n'.join([header] + page + ([footer] if footer else [])) + '\n'
+    if not blocks:
+        return text, next_start
+
+    reply_blocks = [
+        {'type': 'section', 'text': {'type': 'mrkdwn', 'text': f'*{header}*'}}
+    ]
+    reply_blocks.extend(
+        {'type': 'section', 'text': {'type': 'mrkdwn', 'text': line}}
+        for line in page
+    )
+    if footer:
+        reply_blocks.append({
+            'type': 'context',
+            'elements': [{'type': 'mrkdwn', 'text': footer}]
+        })
+
+    return Reply(text, reply_blocks), next_start
@@ -0,0 +1,54 @@
+import heapq
+from collections import namedtuple
+
+TradeMatch = namedtuple(
+    'TradeMatch', ['user_id', 'has_cards', 'needs_cards', 'swaps', 'total'])
+
+
+def bit_count(mask):
+    return bin(mask).count('1')
+
+
+def score_match(user_id, has_cards, needs_cards):
+    """Scores a teammate from the overlap bitmasks returned by the trade query.
+
+    ``swaps`` is the number of one-for-one trades possible with the teammate
+    (both sides give a card) and ``total`` is every card either side could
+    hand over.
+
+    :param str user_id: Slack user ID of the teammate
+    :param int has_cards: Cards the teammate has that the requester needs
+    :param int needs_cards: Cards the teammate needs that the requester has
+
+    :rtype: TradeMatch
+    """
+    has_count = bit_count(has_cards)
+    needs_count = bit_count(needs_cards)
+
+    return TradeMatch(
+        user_id,
+        has_cards,
+        needs_cards,
+        min(has_count, needs_count),
+        has_count + needs_count
+    )
+
+
+def rank_trades(candidates, limit=None):
+    """Returns the best trade partners first, ranked by the number of mutual
+    swaps and then by the total number of cards that could change hands.
+
+    :param candidates: Iterable of ``(user_id, has_cards, needs_cards)``
+    :param int limit: Only return the top ``limit`` partners
+
+    :rtype: list
+    """
+    matches = (score_match(*c) for c in candidates)
+
+    def key(m):
+        return m.swaps, m.total
+
+    if limit:
+        return heapq.nlargest(limit, matches, key=key)
+
+    return sorted(matches, key=key, reverse=True)
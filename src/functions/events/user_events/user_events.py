@@ -1,42 +1,170 @@
 import json
 import logging
-import re
 import os
+from collections import OrderedDict
 
-from botocore.vendored import requests
-from sqlalchemy import create_engine, or_
+from sqlalchemy import and_, or_
+from sqlalchemy.orm.attributes import set_committed_value
 
-from models import Session, SlackTeams, SlackUsers
+from jtg import slack_api
+from jtg.cache import TTLCache
+from jtg.database import (
+    get_read_session, get_session, insert_ignore_duplicates, note_write,
+    pool_status, recently_wrote
+)
+from jtg.idempotency import IdempotencyStore
+from jtg.models import (
+    ALL_CARDS, CARD_COUNT, NotifyCards, Session, SlackTeams, SlackUsers,
+    TradePlans, card_bit, cards_to_mask, mask_to_cards)
+
+from chains import find_trade_cycles
+from commands import CommandException, parse_command
+from metrics import StageTimer
+from outbound import OutboundScheduler
+from render import render_trades
+from trades import rank_trades
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-DATABASE_ENDPOINT = os.getenv('DATABASE_ENDPOINT')
-DATABASE_PORT = os.getenv('DATABASE_PORT')
-DATABASE_USERNAME = os.getenv('DATABASE_USERNAME')
-DATABASE_PASSWORD = os.getenv('DATABASE_PASSWORD')
+# Whether SQS batches are processed together by process_batch. SNS invokes
+# the function with one record at a time, so it always uses process_record.
+BATCH_MODE = bool(int(os.getenv('BATCH_MODE', 1)))
+SHOW_TRADES_LIMIT = int(os.getenv('SHOW_TRADES_LIMIT', 25))
+SHOW_TRADES_MAX_BYTES = int(os.getenv('SHOW_TRADES_MAX_BYTES', 3000))
+SHOW_TRADES_MAX_RESULTS = int(os.getenv('SHOW_TRADES_MAX_RESULTS', 200))
+SHOW_TRADES_BLOCKS = bool(int(os.getenv('SHOW_TRADES_BLOCKS', 0)))
+TRADE_CHAINS_LIMIT = int(os.getenv('TRADE_CHAINS_LIMIT', 5))
+TRADE_CHAINS_TIME_BUDGET = float(os.getenv('TRADE_CHAINS_TIME_BUDGET', 1.0))
+TEAM_CACHE_SIZE = int(os.getenv('TEAM_CACHE_SIZE', 128))
+TEAM_CACHE_TTL = int(os.getenv('TEAM_CACHE_TTL', 300))
+TRADES_CACHE_SIZE = int(os.getenv('TRADES_CACHE_SIZE', 1024))
+TRADES_CACHE_TTL = int(os.getenv('TRADES_CACHE_TTL', 3600))
+NOTIFY_MAX_RECIPIENTS = int(os.getenv('NOTIFY_MAX_RECIPIENTS', 50))
+NOTIFY_REPEAT_WINDOW = int(os.getenv('NOTIFY_REPEAT_WINDOW', 3600))
+OUTBOUND_RATE = float(os.getenv('OUTBOUND_RATE', 1.0))
+OUTBOUND_BURST = int(os.getenv('OUTBOUND_BURST', 2))
+OUTBOUND_MAX_CHARS = int(os.getenv('OUTBOUND_MAX_CHARS', 4000))
+
+# Slack API errors that mean a cached bot token is no longer valid
+TOKEN_ERRORS = ('invalid_auth', 'token_revoked', 'account_inactive')
+
+HELP_TEXT = \
+    "Jamf the Gathering helps you find other JNUC attendees on Slack who " \
+    "have cards to trade with you in your quest to complete the full set " \
+    "of 18!\n\nJust send me the following commands to say which cards you " \
+    "have and which cards you need:\n\n```\nI have 1 2 3\nI need 4-6, 9```\n" \
+    "You can list cards with spaces or commas, use ranges like 1-6, or say " \
+    "'all'.\nAs you make trades, you can report them and update your " \
+    "available cards using:\n```I traded 1 2 for 4 5```\n" \
+    "To find other users to trade with, type:```Show trades```\n" \
+    "To find a chain of trades between three or four people, " \
+    "type:```Show trade chains```\n" \
+    "To see the trades planned for you across the whole team, " \
+    "type:```Show plan```\n" \
+    "To see what cards you have flagged as have or need, type:\n" \
+    "```show mine```\n" \
+    "To get a message when a teammate flags cards that match yours, " \
+    "type:```Notify on```"
+
+UNKNOWN_COMMAND_TEXT = "I'm sorry, I'm not sure what you wanted me to do? " \
+                       "Type 'Help' to learn how I work!"
 
-I_HAVE_RE = re.compile(r'^i\s+have\s+([\d\s]+)(?<!\s)\s*$')
-I_NEED_RE = re.compile(r'^i\s+need\s+([\d\s]+)(?<!\s)\s*$')
-I_TRADED_RE = re.compile(
-    r'^i\s+traded\s+([\d\s]+)(?<!\s)\s+for\s+([\d\s]+)(?<!\s)\s*$')
+Session.configure(expire_on_commit=False)
 
-engine = create_engine(
-    f'mysql+pymysql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@'
-    f'{DATABASE_ENDPOINT}:{DATABASE_PORT}/jamfthegathering?charset=utf8'
-)
-Session.configure(bind=engine, expire_on_commit=False)
+team_cache = TTLCache(maxsize=TEAM_CACHE_SIZE, ttl=TEAM_CACHE_TTL)
+
+# Ranked 'show trades' matches keyed by (user, team cards version). An
+# entry stops being used once the team's version changes.
+trades_cache = TTLCache(maxsize=TRADES_CACHE_SIZE, ttl=TRADES_CACHE_TTL)
+
+# The ranked matches each user's 'show trades' returned and where the next
+# 'more' page starts. Pages come from this snapshot, so card changes after
+# 'show trades' can't shift the list between pages.
+trade_pages = TTLCache(maxsize=TRADES_CACHE_SIZE, ttl=TRADES_CACHE_TTL)
+events_seen = IdempotencyStore('worker')
+
+# Notifications already sent, so flagging the same cards again within
+# NOTIFY_REPEAT_WINDOW doesn't message the same teammates again
+notifications_sent = IdempotencyStore('notify', ttl=NOTIFY_REPEAT_WINDOW)
 
 
-class CommandException(Exception):
-    pass
+def invalidate_team(team_id):
+    """Drops a team from this container's cache. Called when the OAuth flow
+    reports new tokens for the team and when Slack rejects a cached token.
+    Other warm containers pick up the change when their entry expires.
+    """
+    logger.info(f'Invalidating cached Slack team: {team_id}')
+    team_cache.invalidate(team_id)
 
 
-def get_or_create_user(session, data):
-    logger.info(f"Looking up Slack team: {data['team_id']}")
+def get_team(session, team_id):
+    team = team_cache.get(team_id)
+    if team:
+        return team
+
+    logger.info(f'Looking up Slack team: {team_id}')
     team = session.query(SlackTeams).with_entities(
-        SlackTeams.id, SlackTeams.bot_access_token).filter(
-        SlackTeams.team_id == data['team_id']).first()
+        SlackTeams.id, SlackTeams.team_id, SlackTeams.bot_access_token).filter(
+        SlackTeams.team_id == team_id).first()
+
+    if team:
+        team_cache.set(team_id, team)
+
+    return team
+
+
+def find_user(session, team_id, user_id):
+    return session.query(SlackUsers).filter(
+        SlackUsers.slack_team_id == team_id,
+        SlackUsers.user_id == user_id).first()
+
+
+def create_users(session, team_id, user_ids):
+    """Creates the users with a single upsert. Users created concurrently by
+    another invocation are left as they are thanks to the unique
+    ``(slack_team_id, user_id)`` key.
+    """
+    insert_ignore_duplicates(session, SlackUsers.__table__, [
+        {
+            'slack_team_id': team_id,
+            'user_id': user_id,
+            'have_cards': 0,
+            'need_cards': 0
+        } for user_id in user_ids
+    ])
+    session.info['pending_writes'] = True
+
+
+def commit_writes(session):
+    """Commits the session only if a statement wrote to the database, so
+    commands that changed nothing don't cost a round trip. The cards version
+    of every team with changed cards is increased in the same transaction.
+
+    :returns: Whether the session was committed
+    :rtype: bool
+    """
+    if not session.info.pop('pending_writes', False):
+        return False
+
+    changed_teams = session.info.pop('changed_teams', None)
+    if changed_teams:
+        session.query(SlackTeams).filter(
+            SlackTeams.id.in_(changed_teams)
+        ).update(
+            {SlackTeams.cards_version: SlackTeams.cards_version + 1},
+            synchronize_session=False
+        )
+
+    session.commit()
+    return True
+
+
+def get_or_create_user(session, data, timer=None):
+    timer = timer or StageTimer()
+
+    with timer.stage('TeamLookup'):
+        team = get_team(session, data['team_id'])
 
     if not team:
         logger.error(
@@ -44,97 +172,302 @@ def get_or_create_user(session, data):
         return None, None
 
     logger.info(f"Looking up Slack user: {data['event']['user']}")
-    user = session.query(SlackUsers).filter(
-        SlackUsers.user_id == data['event']['user']).first()
+    with timer.stage('UserLookup'):
+        user = find_user(session, team.id, data['event']['user'])
+
+        if not user:
+            logger.info(f"Creating new Slack user: {data['event']['user']}")
+
+            try:
+                create_users(session, team.id, [data['event']['user']])
+                commit_writes(session)
+            except:
+                logger.exception('Unable to write new user to database')
+                session.rollback()
+                session.close()
+                return None, None
 
-    if not user:
-        logger.info(f"Creating new Slack user: {data['event']['user']}")
+            user = find_user(session, team.id, data['event']['user'])
 
-        user = SlackUsers(
-            user_id=data['event']['user'],
-            slack_team_id=team.id
-        )
+    return user, team
 
-        try:
-            session.add(user)
-            session.commit()
-        except:
-            logger.exception('Unable to write new team to database')
-            session.rollback()
-            session.close()
-            return None, None
 
-    return user, team
+def send_chat_message(channel, text, token, team_id=None, blocks=None):
+    body = {
+        'channel': channel,
+        'text': text,
+        'link_names': True
+    }
+    if blocks:
+        body['blocks'] = blocks
+
+    try:
+        data = slack_api.call('chat.postMessage', token=token, json=body)
+    except slack_api.SlackApiError:
+        logger.exception(f'Unable to send a message to {channel}')
+        return None
+
+    logger.info(f'Slack API response: {data}')
 
+    if team_id and data.get('error') in TOKEN_ERRORS:
+        invalidate_team(team_id)
 
-def send_chat_message(channel, text, token):
-    r = requests.post(
-        'https://slack.com/api/chat.postMessage',
-        json={
-            'channel': channel,
-            'text': text,
-            'link_names': True
-        },
-        headers={'Authorization': f'Bearer {token}'},
-        timeout=5
+    return data
+
+
+outbound = OutboundScheduler(
+    send_chat_message,
+    rate=OUTBOUND_RATE,
+    burst=OUTBOUND_BURST,
+    max_chars=OUTBOUND_MAX_CHARS
+)
+
+
+def valid_cards(card_list):
+    return [i for i in card_list if 0 < i <= CARD_COUNT]
+
+
+def update_cards(session, user, have_set=0, have_clear=0, need_set=0,
+                 need_clear=0):
+    """Applies card changes to the user with a single bitwise ``UPDATE``
+    statement. Nothing is sent when the changes leave the user's cards as
+    they are.
+
+    The user's in-memory state is updated without marking it dirty, so the
+    flush on commit doesn't write the columns a second time.
+
+    :returns: Whether the user's cards changed
+    :rtype: bool
+    """
+    old_have = user.have_cards or 0
+    old_need = user.need_cards or 0
+    values = dict()
+
+    for column, to_set, to_clear in (
+            ('have_cards', have_set, have_clear),
+            ('need_cards', need_set, need_clear)):
+        current = getattr(user, column) or 0
+        new = (current | to_set) & (ALL_CARDS & ~to_clear)
+        if new == current:
+            continue
+
+        expression = getattr(SlackUsers, column)
+        if to_set:
+            expression = expression.op('|')(to_set)
+        if to_clear:
+            expression = expression.op('&')(ALL_CARDS & ~to_clear)
+
+        values[column] = (expression, new)
+
+    if not values:
+        return False
+
+    session.query(SlackUsers).filter(SlackUsers.id == user.id).update(
+        {getattr(SlackUsers, c): e for c, (e, _) in values.items()},
+        synchronize_session=False
     )
-    logger.info(f"Slack API response: {r.status_code} {r.json()}")
 
+    for column, (_, new) in values.items():
+        set_committed_value(user, column, new)
+
+    session.info['pending_writes'] = True
+    session.info.setdefault('changed_teams', set()).add(user.slack_team_id)
+
+    if user.notify:
+        index_notify_cards(
+            session,
+            user,
+            added={
+                'have': user.have_cards & ~old_have,
+                'need': user.need_cards & ~old_need
+            },
+            removed={
+                'have': old_have & ~user.have_cards,
+                'need': old_need & ~user.need_cards
+            }
+        )
 
-def parse_int_list(string):
-    try:
-        int_list = [int(i) for i in string.strip().split()]
-    except (TypeError, ValueError):
-        return list()
+    queue_notifications(
+        session,
+        user,
+        added_have=user.have_cards & ~old_have,
+        added_need=user.need_cards & ~old_need
+    )
+    return True
+
+
+def index_notify_cards(session, user, added=None, removed=None):
+    """Adds and removes an opted-in user's rows in the ``notify_cards``
+    reverse index.
+
+    :param dict added: Card bitmasks keyed by ``have`` and ``need`` to add
+    :param dict removed: Card bitmasks keyed by ``have`` and ``need`` to
+        remove
+    """
+    rows = [
+        {
+            'slack_team_id': user.slack_team_id,
+            'card_type': type_,
+            'card': card,
+            'slack_user_id': user.id
+        }
+        for type_, mask in (added or dict()).items()
+        for card in mask_to_cards(mask)
+    ]
+    if rows:
+        insert_ignore_duplicates(session, NotifyCards.__table__, rows)
+
+    for type_, mask in (removed or dict()).items():
+        if mask:
+            session.query(NotifyCards).filter(
+                NotifyCards.slack_user_id == user.id,
+                NotifyCards.card_type == type_,
+                NotifyCards.card.in_(mask_to_cards(mask))
+            ).delete(synchronize_session=False)
+
+
+def queue_notifications(session, user, added_have, added_need):
+    """Finds the opted-in teammates whose cards newly match the user's, from
+    only the cards that were just added, and queues a message for each of
+    them in ``session.info['notifications']``. They are sent once the change
+    is committed.
+
+    At most ``NOTIFY_MAX_RECIPIENTS`` teammates are messaged, the ones who
+    joined first.
+
+    :param int added_have: Cards the user now has that they didn't before
+    :param int added_need: Cards the user now needs that they didn't before
+    """
+    wanted = list()
+    if added_have:
+        wanted.append(and_(
+            NotifyCards.card_type == 'need',
+            NotifyCards.card.in_(mask_to_cards(added_have))
+        ))
+    if added_need:
+        wanted.append(and_(
+            NotifyCards.card_type == 'have',
+            NotifyCards.card.in_(mask_to_cards(added_need))
+        ))
+
+    if not wanted:
+        return
+
+    # The primary key starts with (slack_team_id, card_type, card), so only
+    # the rows for the added cards are read.
+    rows = session.query(NotifyCards)\
+        .join(SlackUsers, SlackUsers.id == NotifyCards.slack_user_id)\
+        .with_entities(
+            SlackUsers.user_id, NotifyCards.card_type, NotifyCards.card)\
+        .filter(
+            NotifyCards.slack_team_id == user.slack_team_id,
+            NotifyCards.slack_user_id != user.id,
+            or_(*wanted)
+        ).order_by(NotifyCards.slack_user_id).all()
+
+    # Teammate -> [cards they need that the user has, cards they have]
+    matches = OrderedDict()
+    for row in rows:
+        masks = matches.setdefault(row.user_id, [0, 0])
+        masks[row.card_type == 'have'] |= card_bit(row.card)
+
+    if len(matches) > NOTIFY_MAX_RECIPIENTS:
+        logger.warning(
+            f'{len(matches)} teammates match the cards of '
+            f"'{user.user_id}', only notifying the first "
+            f'{NOTIFY_MAX_RECIPIENTS}')
+
+    notifications = session.info.setdefault('notifications', list())
+
+    for user_id, (needs_cards, has_cards) in \
+            list(matches.items())[:NOTIFY_MAX_RECIPIENTS]:
+        parts = list()
+        if needs_cards:
+            cards = ', '.join(str(i) for i in mask_to_cards(needs_cards))
+            parts.append(f'now has {cards} that you need')
+        if has_cards:
+            cards = ', '.join(str(i) for i in mask_to_cards(has_cards))
+            parts.append(f'now needs {cards} that you have')
+
+        notifications.append((
+            user.slack_team_id,
+            user_id,
+            f"Trade match! <@{user.user_id}> {' and '.join(parts)}\n"
+            f"Type 'notify off' to stop these messages.",
+            f'{user.slack_team_id}:{user.user_id}:{user_id}:'
+            f'{needs_cards}:{has_cards}'
+        ))
+
+
+def send_notifications(session, teams):
+    """Queues the committed notifications as direct messages. A teammate
+    isn't sent the same match again within ``NOTIFY_REPEAT_WINDOW`` seconds,
+    e.g. when the user clears and flags the same card again.
+
+    :param dict teams: Team rows keyed by their database ID
+    """
+    for team_id, user_id, text, key in session.info.pop('notifications', ()):
+        team = teams.get(team_id)
+        if not team:
+            continue
 
-    return int_list
+        if not notifications_sent.claim(key):
+            logger.info(f'Already notified {user_id} of this match')
+            continue
 
+        outbound.enqueue(user_id, text, team.bot_access_token, team.team_id)
 
-def update_cards(user, type_, card_list, set_to=True):
-    completed = list()
-    for i in card_list:
-        if 0 < i < 19:
-            attr_name = f'{type_}_{i}'
-            setattr(user, attr_name, set_to)
-            completed.append(i)
 
-    return completed
+def command_help(session, user):
+    return HELP_TEXT
 
 
-def command_i_have(user, com_string):
-    match = I_HAVE_RE.match(com_string)
-    if not match:
-        raise CommandException
+def command_notify(session, user, enabled):
+    if bool(user.notify) != enabled:
+        session.query(SlackUsers).filter(SlackUsers.id == user.id).update(
+            {SlackUsers.notify: enabled}, synchronize_session=False)
+        set_committed_value(user, 'notify', enabled)
+        session.info['pending_writes'] = True
 
-    card_list = parse_int_list(match.group(1))
-    completed = update_cards(user, 'have', card_list)
+        cards = {'have': user.have_cards or 0, 'need': user.need_cards or 0}
+        if enabled:
+            index_notify_cards(session, user, added=cards)
+        else:
+            index_notify_cards(session, user, removed=cards)
 
-    return 'I have flagged the following cards available for trade: ' \
-           f'{", ".join([str(i) for i in completed])}\n'
+    if enabled:
+        return "I'll message you when a teammate flags cards that match " \
+               "yours. Type 'notify off' to stop."
 
+    return "I won't message you about new trade matches. Type 'notify on' " \
+           "to start again."
 
-def command_i_need(user, com_string):
-    match = I_NEED_RE.match(com_string)
-    if not match:
-        raise CommandException
 
-    card_list = parse_int_list(match.group(1))
-    completed = update_cards(user, 'need', card_list)
+def command_i_have(session, user, card_list):
+    completed = valid_cards(card_list)
+    update_cards(session, user, have_set=cards_to_mask(completed))
 
-    return 'I have flagged the following cards as needing to trade for: ' \
+    return 'I have flagged the following cards available for trade: ' \
            f'{", ".join([str(i) for i in completed])}\n'
 
 
-def command_i_traded(user, com_string):
-    match = I_TRADED_RE.match(com_string)
-    if not match:
-        raise CommandException
+def command_i_need(session, user, card_list):
+    completed = valid_cards(card_list)
+    update_cards(session, user, need_set=cards_to_mask(completed))
+
+    return 'I have flagged the following cards as needing to trade for: ' \
+           f'{", ".join([str(i) for i in completed])}\n'
 
-    trade_out_list = parse_int_list(match.group(1))
-    trade_in_list = parse_int_list(match.group(2))
 
-    traded_out = update_cards(user, 'have', trade_out_list, False)
-    traded_in = update_cards(user, 'need', trade_in_list, False)
+def command_i_traded(session, user, trade_out_list, trade_in_list):
+    traded_out = valid_cards(trade_out_list)
+    traded_in = valid_cards(trade_in_list)
+    update_cards(
+        session,
+        user,
+        have_clear=cards_to_mask(traded_out),
+        need_clear=cards_to_mask(traded_in)
+    )
 
     return f'I have updated your cards!\n' \
            f'{", ".join([str(i) for i in traded_out])} ' \
@@ -144,65 +477,182 @@ def command_i_traded(user, com_string):
 
 
 def read_user_cards(user, type_):
-    attr_list = list()
+    return [str(i) for i in user.get_cards(type_)]
+
+
+def get_cards_version(session, team_id):
+    return session.query(SlackTeams.cards_version).filter(
+        SlackTeams.id == team_id).scalar()
+
+
+def get_ranked_trades(session, user):
+    # Changes waiting to be committed haven't increased the version yet.
+    if user.slack_team_id in session.info.get('changed_teams', ()):
+        return find_trades(session, user)
+
+    key = (user.id, get_cards_version(session, user.slack_team_id))
+    matches = trades_cache.get(key)
+
+    if matches is None:
+        matches = find_trades(session, user)
+        trades_cache.set(key, matches)
 
-    for i in range(1, 19):
-        attr_name = f'{type_}_{i}'
-        if getattr(user, attr_name):
-            attr_list.append(attr_name)
+    return matches
 
-    return attr_list
+
+def show_trades_page(user, matches, start):
+    if start >= len(matches):
+        trade_pages.invalidate(user.id)
+        return None
+
+    reply, next_start = render_trades(
+        matches,
+        start,
+        max_items=SHOW_TRADES_LIMIT,
+        max_bytes=SHOW_TRADES_MAX_BYTES,
+        blocks=SHOW_TRADES_BLOCKS
+    )
+
+    if next_start is None:
+        trade_pages.invalidate(user.id)
+    else:
+        trade_pages.set(user.id, (matches, next_start))
+
+    return reply
 
 
 def command_show_trades(session, user):
-    card_filter_list = list()
+    if not (user.have_cards or user.need_cards):
+        return 'Sorry, no trades available yet!'
 
-    user_have_list = read_user_cards(user, 'have')
-    user_need_list = read_user_cards(user, 'need')
+    return show_trades_page(user, get_ranked_trades(session, user), 0) or \
+        'Sorry, no trades available yet!'
 
-    filtered_need_list = [f"need_{i.split('_')[-1]}" for i in user_have_list]
-    filtered_have_list = [f"have_{i.split('_')[-1]}" for i in user_need_list]
 
-    for i in filtered_need_list:
-        card_filter_list.append(
-            getattr(user, i) == True)
+def command_more(session, user):
+    page = trade_pages.get(user.id)
+    reply = show_trades_page(user, *page) if page else None
 
-    for i in filtered_have_list:
-        card_filter_list.append(
-            getattr(user, i) == True)
+    return reply or "There are no more trades to show. Type 'show trades' " \
+                    "to see them from the top."
 
-    results = session.query(SlackUsers)\
+
+def find_trades(session, user):
+    """Finds the teammates the user can trade with.
+
+    :returns: The best ``SHOW_TRADES_MAX_RESULTS`` matches, ranked
+    :rtype: list
+    """
+    have_mask = user.have_cards or 0
+    need_mask = user.need_cards or 0
+
+    # Each side of the trade is masked in SQL so only teammates with an
+    # overlapping card are returned, along with the overlapping bits.
+    they_have = SlackUsers.have_cards.op('&')(need_mask)
+    they_need = SlackUsers.need_cards.op('&')(have_mask)
+
+    candidates = session.query(SlackUsers)\
+        .with_entities(
+            SlackUsers.user_id,
+            they_have.label('has_cards'),
+            they_need.label('needs_cards')
+        )\
         .filter(
-            SlackUsers.user_id != user.user_id,
-            SlackUsers.slack_team_id == user.slack_team_id
+            SlackUsers.slack_team_id == user.slack_team_id,
+            SlackUsers.user_id != user.user_id
         )\
         .filter(
-            or_(*card_filter_list)
+            or_(they_have != 0, they_need != 0)
+        )
+
+    # Rows are ranked as they are read, keeping only the best matches.
+    return rank_trades(candidates, SHOW_TRADES_MAX_RESULTS)
+
+
+def command_show_trade_chains(session, user):
+    if not (user.have_cards and user.need_cards):
+        return 'Sorry, no trade chains available yet!'
+
+    # Only members who both have and need cards can be part of a cycle.
+    members = session.query(SlackUsers)\
+        .with_entities(
+            SlackUsers.user_id, SlackUsers.have_cards, SlackUsers.need_cards)\
+        .filter(
+            SlackUsers.slack_team_id == user.slack_team_id,
+            SlackUsers.have_cards != 0,
+            SlackUsers.need_cards != 0
         ).all()
 
-    message_text = 'Here are the available trades for you:\n'
-    if not results:
-        message_text = 'Sorry, no trades available yet!'
+    cycles = find_trade_cycles(
+        user.user_id,
+        members,
+        limit=TRADE_CHAINS_LIMIT,
+        time_budget=TRADE_CHAINS_TIME_BUDGET
+    )
 
-    for ru in results:
-        result_has_list = [i.split('_')[-1] for i in read_user_cards(ru, 'have') if i in filtered_have_list]
-        result_need_list = [i.split('_')[-1] for i in read_user_cards(ru, 'need') if i in filtered_need_list]
+    if not cycles:
+        return 'Sorry, no trade chains available yet!'
 
-        if not (result_has_list or result_need_list):
-            continue
+    def name(user_id):
+        return 'you' if user_id == user.user_id else f'<@{user_id}>'
+
+    message_text = 'Here are trade chains that include you:\n'
+    for cycle in cycles:
+        message_text += ', '.join(
+            f'{name(s.giver)} give{"" if s.giver == user.user_id else "s"} '
+            f'{s.card} to {name(s.receiver)}' for s in cycle
+        ) + '\n'
+
+    return message_text
 
-        if result_has_list:
-            result_has_list = f"has {', '.join(result_has_list)}"
 
-        if result_need_list:
-            result_need_list = f"needs {', '.join(result_need_list)}"
+def command_show_plan(session, user):
+    entries = session.query(TradePlans).filter(
+        TradePlans.slack_team_id == user.slack_team_id,
+        or_(
+            TradePlans.giver_user_id == user.user_id,
+            TradePlans.receiver_user_id == user.user_id
+        )
+    ).order_by(TradePlans.swap_id, TradePlans.card).all()
+
+    # Skip anything the user has already traded since the plan was made.
+    def still_valid(entry):
+        if entry.giver_user_id == user.user_id:
+            return bool(user.have_cards & card_bit(entry.card))
+        return bool(user.need_cards & card_bit(entry.card))
+
+    entries = [e for e in entries if still_valid(e)]
+    if not entries:
+        return "You don't have any planned trades yet!"
+
+    swaps = dict()
+    lines = list()
+
+    for entry in entries:
+        if entry.swap_id:
+            swaps.setdefault(entry.swap_id, list()).append(entry)
+        elif entry.giver_user_id == user.user_id:
+            lines.append(f'Give {entry.card} to <@{entry.receiver_user_id}>')
+        else:
+            lines.append(f'Get {entry.card} from <@{entry.giver_user_id}>')
+
+    for pair in swaps.values():
+        give = [e for e in pair if e.giver_user_id == user.user_id]
+        get = [e for e in pair if e.receiver_user_id == user.user_id]
+        if give and get:
+            lines.insert(
+                0,
+                f'Swap with <@{give[0].receiver_user_id}>: you give '
+                f'{give[0].card} and get {get[0].card}'
+            )
 
-        message_text += f"<@{ru.user_id}> {' and '.join([l for l in (result_has_list, result_need_list) if l])}\n"
+    message_text = 'Here are your planned trades:\n'
+    message_text += '\n'.join(lines)
 
     return message_text
 
 
-def command_show_mine(user):
+def command_show_mine(session, user):
     has_list = read_user_cards(user, 'have')
     needs_list = read_user_cards(user, 'need')
 
@@ -211,112 +661,543 @@ def command_show_mine(user):
 
     message_text = 'You have flagged the following cards:'
     if has_list:
-        message_text += f"\nYou have {', '.join([i.split('_')[-1] for i in has_list])}"
+        message_text += f"\nYou have {', '.join(has_list)}"
     if needs_list:
-        message_text += f"\nYou need {', '.join([i.split('_')[-1] for i in needs_list])}"
+        message_text += f"\nYou need {', '.join(needs_list)}"
 
     return message_text
 
 
-def process_command(input_text, session, user):
-    commit = True
-    message_text = ''
-
+# Command name -> (function, whether the command writes to the database)
+COMMANDS = {
+    'help': (command_help, False),
+    'i have': (command_i_have, True),
+    'i need': (command_i_need, True),
+    'i traded': (command_i_traded, True),
+    'show trades': (command_show_trades, False),
+    'show trade chains': (command_show_trade_chains, False),
+    'show plan': (command_show_plan, False),
+    'show mine': (command_show_mine, False),
+    'notify': (command_notify, True),
+    'more': (command_more, False)
+}
+
+
+def read_command(input_text):
+    """Parses a message once, so that choosing the database session and
+    running the command share the result.
+
+    :returns: The command name and arguments, ``(None, ())`` if the message
+        isn't a known command or None if its arguments are invalid
+    :rtype: tuple
+    """
     try:
-        if input_text.startswith('help'):
-            message_text = \
-                "Jamf the Gathering helps you find other JNUC attendees on " \
-                "Slack who have cards to trade with you in your quest to " \
-                "complete the full set of 18!\n\nJust send me the " \
-                "following commands to say which cards you have and which " \
-                "cards you need:\n\n```\nI have 1 2 3\nI need 4 5 6```\nAs " \
-                "you make trades, you can report them and update your " \
-                "available cards using:\n```I traded 1 2 for 4 5```\n" \
-                "To find other users to trade with, type:```Show trades```\n" \
-                "To see what cards you have flagged as have or need, type:\n" \
-                "```show mine```"
-        elif input_text.startswith('i have'):
-            message_text = command_i_have(user, input_text)
-
-        elif input_text.startswith('i need'):
-            message_text = command_i_need(user, input_text)
-
-        elif input_text.startswith('i traded'):
-            message_text = command_i_traded(user, input_text)
-
-        elif input_text.startswith('show trades'):
-            message_text = command_show_trades(session, user)
-            commit = False
+        return parse_command(input_text)
+    except CommandException:
+        return None
 
-        elif input_text.startswith('show mine'):
-            message_text = command_show_mine(user)
-            commit = False
 
-    except CommandException:
-        message_text = 'Whoops, something went wrong!'
-        commit = False
+def is_read_only(command):
+    """Whether a command from ``read_command()`` only reads, so it can run
+    on the reader.
+    """
+    return command is not None and command[0] is not None and \
+        not COMMANDS[command[0]][1]
+
+
+def run_command(command, session, user, timer=None):
+    """Runs a command from ``read_command()`` against the user without
+    committing. The command name is added to the timer's dimensions.
+
+    :returns: The reply text and whether the command can write to the
+        database
+    :rtype: tuple
+    """
+    timer = timer or StageTimer()
+
+    with timer.stage('CommandExecution'):
+        if command is None:
+            return 'Whoops, something went wrong!', False
+
+        name, args = command
+        if name is None:
+            timer.dimensions['Command'] = 'unknown'
+            return UNKNOWN_COMMAND_TEXT, False
+
+        timer.dimensions['Command'] = name
+        func, commit = COMMANDS[name]
+
+        try:
+            message_text = func(session, user, *args)
+        except CommandException:
+            return 'Whoops, something went wrong!', False
+
+    return message_text, commit
+
+
+def process_command(command, session, user, timer=None):
+    timer = timer or StageTimer()
+    message_text, commit = run_command(command, session, user, timer)
 
     if commit:
         try:
-            session.commit()
+            with timer.stage('Commit'):
+                if commit_writes(session):
+                    note_write(user.id)
         except:
             logger.exception(f"Unable to update Slack user '{user.user_id}'")
             session.rollback()
+            session.info.pop('notifications', None)
             return 'Whoops, something went wrong!'
 
-    if not message_text:
-        message_text = "I'm sorry, I'm not sure what you wanted me to do? " \
-                       "Type 'Help' to learn how I work!"
-
     return message_text
 
 
-def lambda_handler(event, context):
-    if event.get('Records'):
-        logging.info('Processing SNS records...')
-        for record in event['Records']:
-            session = Session()
+def is_valid_message(data):
+    """Whether a message from the events topic has the fields that the
+    handlers rely on. Events the bot doesn't act on, such as unsupported
+    types and messages with a subtype, only need a ``type``.
+    """
+    if not isinstance(data, dict):
+        return False
 
-            data = json.loads(record['Sns']['Message'])
-            logger.info(data)
+    if data.get('type') == 'team_tokens_updated':
+        return isinstance(data.get('team_id'), str)
 
-            user, team = get_or_create_user(session, data)
+    event = data.get('event')
+    if not isinstance(event, dict) or not isinstance(data.get('team_id'), str):
+        return False
 
-            if not (user and team):
-                session.close()
-                continue
+    if event.get('type') not in ('app_mention', 'message') or \
+            event.get('subtype'):
+        return isinstance(event.get('type'), str)
+
+    return all(
+        isinstance(event.get(field), str)
+        for field in ('user', 'text', 'channel')
+    )
+
+
+def read_input_text(data):
+    """Returns the command text of a Slack event and whether the reply should
+    mention the user, or ``(None, False)`` for unsupported events.
+    """
+    if data['event'].get('subtype'):
+        logger.info(f"Ignoring '{data['event']['subtype']}' message")
+        return None, False
+
+    elif data['event']['type'] == 'app_mention':
+        return data['event']['text'].lower().split(maxsplit=1)[-1], True
+
+    elif data['event']['type'] == 'message':
+        return data['event']['text'].lower(), False
+
+    logger.warning(f"Event '{data['event']['type']}' is not supported!")
+    return None, False
+
+
+def get_teams(session, team_ids):
+    """Looks up all of the given Slack teams, querying the ones that are not
+    cached in one query.
 
-            dm_user = False
+    :returns: Team rows keyed by the Slack team ID
+    :rtype: dict
+    """
+    teams = dict()
+    for team_id in team_ids:
+        team = team_cache.get(team_id)
+        if team:
+            teams[team_id] = team
 
-            if data['event']['type'] == 'app_mention':
-                dm_user = True
-                input_text = \
-                    data['event']['text'].lower().split(maxsplit=1)[-1]
+    missing = [i for i in team_ids if i not in teams]
+    if missing:
+        results = session.query(SlackTeams).with_entities(
+            SlackTeams.id, SlackTeams.team_id, SlackTeams.bot_access_token)\
+            .filter(SlackTeams.team_id.in_(missing)).all()
 
-            elif data['event']['type'] == 'message':
-                input_text = data['event']['text'].lower()
+        for team in results:
+            team_cache.set(team.team_id, team)
+            teams[team.team_id] = team
 
-            else:
-                logger.warning(f"Event '{data['event']['type']}' is not supported!")
+    return teams
+
+
+def is_team_update(data):
+    """Handles the ``team_tokens_updated`` notification published by the
+    OAuth redirect after a team's tokens are saved.
+    """
+    if data.get('type') != 'team_tokens_updated':
+        return False
+
+    invalidate_team(data['team_id'])
+    return True
+
+
+def is_duplicate(data):
+    """Drops events that were already processed. The API drops most Slack
+    retries, but one that reaches a different container than the first
+    delivery is only caught here or by the shared table.
+    """
+    if events_seen.claim(data.get('event_id')):
+        return False
+
+    logger.info(f"Dropping duplicate event {data['event_id']}")
+    return True
+
+
+def get_or_create_users(session, team_users):
+    """Looks up the users of every team in one query. Missing users are
+    created with one upsert and then read back with one more query. Nothing
+    is committed.
+
+    :param dict team_users: Sets of Slack user IDs keyed by the team's
+        database ID
+
+    :returns: Users keyed by ``(slack_team_id, user_id)``
+    :rtype: dict
+    """
+    def query_users(team_users):
+        return session.query(SlackUsers).filter(
+            or_(*[
+                and_(
+                    SlackUsers.slack_team_id == team_id,
+                    SlackUsers.user_id.in_(user_ids)
+                ) for team_id, user_ids in team_users.items()
+            ])).all()
+
+    user_map = {(u.slack_team_id, u.user_id): u for u in query_users(team_users)}
+
+    missing = dict()
+    for team_id, user_ids in team_users.items():
+        for user_id in user_ids:
+            if (team_id, user_id) not in user_map:
+                logger.info(f'Creating new Slack user: {user_id}')
+                missing.setdefault(team_id, list()).append(user_id)
+
+    if missing:
+        for team_id, user_ids in missing.items():
+            create_users(session, team_id, user_ids)
+
+        user_map.update({
+            (u.slack_team_id, u.user_id): u for u in query_users(missing)})
+
+    return user_map
+
+
+def read_record(record):
+    """Returns the message published to the events topic from an SNS record
+    or an SQS message. The queue's subscription uses raw message delivery,
+    but an SNS envelope is unwrapped too.
+    """
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+
+    data = json.loads(record['body'])
+    if isinstance(data, dict) and data.get('Type') == 'Notification' and \
+            'Message' in data:
+        return json.loads(data['Message'])
+
+    return data
+
+
+def release_events(messages):
+    """Releases the idempotency keys of events that will be redelivered."""
+    for _, data in messages:
+        events_seen.release(data.get('event_id'))
+
+
+def process_batch(messages, retry_failures=False):
+    """Processes a batch of Slack events from the SQS queue with a single
+    session. SNS delivers one record per invocation, so there is nothing to
+    batch on that path.
+
+    Records are grouped by team, teams and users are each resolved with one
+    query and every card change is committed in a single transaction. Replies
+    are sent once the transaction has been committed.
+
+    The metrics of each event include the time of the shared team lookup,
+    user lookup and commit, as every event in the batch waits for them.
+
+    :param list messages: ``(message_id, data)`` tuples
+    :param bool retry_failures: Return the events that failed so they can be
+        redelivered instead of replying that something went wrong
+
+    :returns: The message IDs of invalid messages and of the events that
+        failed and should be redelivered
+    :rtype: list
+    """
+    batch_timer = StageTimer()
+    events = list()
+    invalid = list()
+    for message_id, data in messages:
+        logger.info(data)
+
+        # Checked before the event is claimed, so a malformed message can't
+        # fail the batch after other events were claimed.
+        if not is_valid_message(data):
+            logger.error(f'Invalid message {message_id}: {data}')
+            invalid.append(message_id)
+            continue
+
+        if is_team_update(data):
+            continue
+
+        input_text, dm_user = read_input_text(data)
+        if input_text is None or is_duplicate(data):
+            continue
+
+        events.append((message_id, data, input_text, dm_user))
+
+    if not events:
+        return invalid
+
+    # A stable sort keeps each user's commands in the order they were sent.
+    events.sort(key=lambda e: e[1]['team_id'])
+
+    session = None
+    read_session = False
+    replies = list()
+    writes = list()
+    writers = set()
+    timers = list()
+    commit = True
+
+    try:
+        session = get_session()
+        with batch_timer.stage('TeamLookup'):
+            teams = get_teams(session, {e[1]['team_id'] for e in events})
+
+        team_users = dict()
+        for _, data, _, _ in events:
+            team = teams.get(data['team_id'])
+            if not team:
+                logger.error(
+                    f"The Slack user's team wasn't found! Team: {data['team_id']}")
                 continue
 
-            message_text = process_command(input_text, session, user)
-            session.close()
+            team_users.setdefault(team.id, set()).add(data['event']['user'])
+
+        if not team_users:
+            return invalid
 
-            if not message_text:
-                logger.info('Unknown command or request')
+        with batch_timer.stage('UserLookup'):
+            users = get_or_create_users(session, team_users)
+
+        for message_id, data, input_text, dm_user in events:
+            team = teams.get(data['team_id'])
+            if not team:
                 continue
 
+            timer = StageTimer(Team=team.team_id)
+            user = users[(team.id, data['event']['user'])]
+
+            # Read-only commands share one reader session, unless the user
+            # wrote earlier in this batch or within the read-your-writes
+            # window.
+            command = read_command(input_text)
+            command_session = session
+            if is_read_only(command) and user.id not in writers and \
+                    not recently_wrote(user.id):
+                if read_session is False:
+                    read_session = get_read_session()
+                command_session = read_session or session
+
+            message_text, write = run_command(
+                command, command_session, user, timer)
+            if write:
+                writers.add(user.id)
+
             if dm_user:
                 message_text = f'<@{user.user_id}> ' + message_text
 
-            send_chat_message(
+            timers.append(timer)
+            writes.append((message_id, data, write))
+            replies.append((
                 data['event']['channel'],
                 message_text,
-                team.bot_access_token
-            )
+                team.bot_access_token,
+                team.team_id
+            ))
+
+        try:
+            with batch_timer.stage('Commit'):
+                if commit_writes(session):
+                    for user_id in writers:
+                        note_write(user_id)
+        except:
+            logger.exception('Unable to commit the batch of Slack events')
+            session.rollback()
+            session.info.pop('notifications', None)
+            commit = False
+
+    except Exception:
+        # Nothing was committed, so the events are released for the retry
+        # of the invocation or the redelivery of the messages.
+        failed = [(e[0], e[1]) for e in events]
+        release_events(failed)
+        if not retry_failures:
+            raise
+
+        logger.exception('Unable to process the batch of Slack events')
+        return invalid + [message_id for message_id, _ in failed]
+
+    finally:
+        if session is not None:
+            session.close()
+        if read_session:
+            read_session.close()
+
+    failed = list()
+    if not commit and retry_failures:
+        # Only the events that wrote are redelivered. The replies of the
+        # read-only commands are still valid.
+        failed = [(m, data) for m, data, write in writes if write]
+        kept = [i for i, (_, _, write) in enumerate(writes) if not write]
+        timers = [timers[i] for i in kept]
+        replies = [replies[i] for i in kept]
+        release_events(failed)
+
+    elif not commit:
+        replies = [
+            (c, 'Whoops, something went wrong!', token, team_id)
+            for c, _, token, team_id in replies
+        ]
+
+    for i, (command_timer, reply) in enumerate(zip(timers, replies)):
+        timers[i] = batch_timer.copy(**command_timer.dimensions)
+        timers[i].add(
+            'CommandExecution', command_timer.timings['CommandExecution'])
+        outbound.enqueue(*reply, timer=timers[i])
+
+    send_notifications(session, {t.id: t for t in teams.values()})
+    outbound.flush()
+
+    for timer in timers:
+        timer.emit()
+
+    return invalid + [message_id for message_id, _ in failed]
+
+
+def process_record(data):
+    logger.info(data)
+
+    if not is_valid_message(data):
+        logger.error(f'Invalid message: {data}')
+        return
+
+    if is_team_update(data):
+        return
+
+    input_text, dm_user = read_input_text(data)
+    if input_text is None or is_duplicate(data):
+        return
+
+    timer = StageTimer(Team=data['team_id'])
+    session = None
+    read_session = None
+
+    try:
+        session = get_session()
+        user, team = get_or_create_user(session, data, timer)
+
+        if not (user and team):
+            return
+
+        command = read_command(input_text)
+        if is_read_only(command):
+            read_session = get_read_session(user.id)
+
+        message_text = process_command(
+            command, read_session or session, user, timer)
+    except Exception:
+        # E.g. Aurora resuming. The event is released so Lambda's retry
+        # isn't dropped as a duplicate.
+        events_seen.release(data.get('event_id'))
+        raise
+    finally:
+        if read_session is not None:
+            read_session.close()
+        if session is not None:
+            session.close()
+
+    if not message_text:
+        logger.info('Unknown command or request')
+        return
+
+    if dm_user:
+        message_text = f'<@{user.user_id}> ' + message_text
+
+    outbound.enqueue(
+        data['event']['channel'],
+        message_text,
+        team.bot_access_token,
+        team.team_id,
+        timer=timer
+    )
+    send_notifications(session, {team.id: team})
+    outbound.flush()
+
+    timer.emit()
+
+
+def process_queue_messages(records):
+    """Processes a batch of SQS messages. A message that can't be read or
+    whose event fails is reported back so only it is retried, and it moves
+    to the dead-letter queue once the queue's receive limit is reached.
+
+    :returns: The message IDs that failed
+    :rtype: list
+    """
+    messages = list()
+    failures = list()
+
+    for record in records:
+        try:
+            messages.append((record['messageId'], read_record(record)))
+        except (KeyError, TypeError, ValueError):
+            logger.exception(f"Unable to read SQS message {record['messageId']}")
+            failures.append(record['messageId'])
+
+    if BATCH_MODE:
+        failures.extend(process_batch(messages, retry_failures=True))
+        return failures
+
+    for message_id, data in messages:
+        if not is_valid_message(data):
+            logger.error(f'Invalid message {message_id}: {data}')
+            failures.append(message_id)
+            continue
+
+        try:
+            process_record(data)
+        except Exception:
+            logger.exception(f'Unable to process SQS message {message_id}')
+            failures.append(message_id)
+
+    return failures
+
+
+def lambda_handler(event, context):
+    records = event.get('Records')
+    response = dict()
+
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        logging.info('Processing SQS messages...')
+        failures = process_queue_messages(records)
+        if failures:
+            logger.warning(f'Failed SQS messages: {failures}')
+
+        response['batchItemFailures'] = [
+            {'itemIdentifier': message_id} for message_id in failures]
+
+    elif records:
+        logging.info('Processing SNS records...')
+        for record in records:
+            process_record(read_record(record))
 
     else:
-        logging.warning('No SNS records found in the event')
+        logging.warning('No SNS or SQS records found in the event')
 
-    return {}
+    logger.info(f'Database pool: {pool_status()}')
+    logger.info(f'Show trades cache: {trades_cache.stats()}')
+    return response
@@ -2,10 +2,9 @@ import json
 import logging
 import os
 
-from sqlalchemy import create_engine
-from botocore.vendored import requests
-
-from models import Session, SlackTeams
+from jtg import slack_api
+from jtg.database import get_session
+from jtg.models import SlackTeams
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -13,21 +12,11 @@ logger.setLevel(logging.INFO)
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 DOMAIN_NAME = os.getenv('DOMAIN_NAME')
-
-DATABASE_ENDPOINT = os.getenv('DATABASE_ENDPOINT')
-DATABASE_PORT = os.getenv('DATABASE_PORT')
-DATABASE_USERNAME = os.getenv('DATABASE_USERNAME')
-DATABASE_PASSWORD = os.getenv('DATABASE_PASSWORD')
-
-engine = create_engine(
-    f'mysql+pymysql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@'
-    f'{DATABASE_ENDPOINT}:{DATABASE_PORT}/jamfthegathering?charset=utf8'
-)
-Session.configure(bind=engine)
+EVENTS_TOPIC = os.getenv('EVENTS_TOPIC')
 
 
 def save_new_team(token_data):
-    session = Session()
+    session = get_session()
 
     team = session.query(SlackTeams).filter(
         SlackTeams.team_id == token_data['team_id']).first()
@@ -58,6 +47,30 @@ def save_new_team(token_data):
         session.close()
 
 
+def notify_team_updated(team_id):
+    """Tells the user events function to drop its cached copy of the team so
+    the new bot token is used for the next reply.
+    """
+    if not EVENTS_TOPIC:
+        return
+
+    # boto3 is only needed once a team has been saved, so it stays out of
+    # the cold start of the error paths.
+    import boto3
+    from botocore.exceptions import ClientError
+
+    logger.info(f'Sending team update notification for {team_id}...')
+    try:
+        boto3.client('sns').publish(
+            TopicArn=EVENTS_TOPIC,
+            Message=json.dumps(
+                {'type': 'team_tokens_updated', 'team_id': team_id}),
+            MessageStructure='string'
+        )
+    except ClientError as error:
+        logger.exception(f'Error sending SNS notification: {error}')
+
+
 def response(message, status_code):
     """Returns a dictionary object for an API Gateway Lambda integration
     response.
@@ -81,16 +94,18 @@ def response(message, status_code):
 
 
 def get_access_tokens(code):
-    r = requests.post(
-        'https://slack.com/api/oauth.access',
+    return slack_api.call(
+        'oauth.access',
         data={
             'client_id': CLIENT_ID,
             'client_secret': CLIENT_SECRET,
             'code': code,
             'redirect_uri': f'https://{DOMAIN_NAME}/slack/oauth/redirect'
-        }
+        },
+        # The code can only be exchanged once, so a retry after a request
+        # that reached Slack would fail with invalid_code.
+        retries=0
     )
-    return r.json()
 
 
 def lambda_handler(event, context):
@@ -101,7 +116,12 @@ def lambda_handler(event, context):
         print(error)
         return response(error, 200)
 
-    access_tokens = get_access_tokens(code)
+    try:
+        access_tokens = get_access_tokens(code)
+    except slack_api.SlackApiError:
+        logger.exception('Unable to obtain access tokens')
+        return response('failed', 500)
+
     logger.info(f'Obtained access tokens: {access_tokens}')
 
     try:
@@ -109,4 +129,6 @@ def lambda_handler(event, context):
     except:
         return response('failed', 500)
 
+    notify_team_updated(access_tokens['team_id'])
+
     return response('success', 200)
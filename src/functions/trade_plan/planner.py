@@ -0,0 +1,175 @@
+from collections import defaultdict, deque, namedtuple
+
+from jtg.models import CARD_COUNT, card_bit, mask_to_cards
+
+Transfer = namedtuple('Transfer', ['giver', 'receiver', 'card', 'swap_id'])
+
+
+def card_capacity(holders, needers):
+    """The most needs of one card that its holders can fill. Members can't
+    give a card to themselves, which only matters when the same member is
+    the only holder and the only needer.
+    """
+    if len(holders) == len(needers) == 1 and holders == needers:
+        return 0
+
+    return min(len(holders), len(needers))
+
+
+def match_card(givers, receivers):
+    """Pairs the givers and receivers of one card so that no member gives to
+    themselves, filling ``card_capacity()`` needs.
+
+    :returns: ``(giver, receiver)`` pairs
+    :rtype: list
+    """
+    count = min(len(givers), len(receivers))
+    pairs = [list(pair) for pair in zip(givers[:count], receivers[:count])]
+    spare_givers = deque(givers[count:])
+    spare_receivers = deque(receivers[count:])
+
+    for i, pair in enumerate(pairs):
+        if pair[0] != pair[1]:
+            continue
+
+        # Givers and receivers are each distinct, so none of these fixes can
+        # pair another member with themselves.
+        if spare_receivers:
+            spare_receivers.append(pair[1])
+            pair[1] = spare_receivers.popleft()
+        elif spare_givers:
+            spare_givers.append(pair[0])
+            pair[0] = spare_givers.popleft()
+        elif len(pairs) > 1:
+            other = pairs[i - 1]
+            pair[1], other[1] = other[1], pair[1]
+
+    return [tuple(pair) for pair in pairs if pair[0] != pair[1]]
+
+
+def plan_trades(members):
+    """Computes a trade plan for a team that fills as many needs as possible.
+
+    Every member gives each card they have at most once and receives each
+    card they need at most once, so each card can fill at most
+    ``card_capacity()`` needs, and the plan fills that many for every card.
+
+    The planner pairs mutual swaps first, so trades are one-for-one where
+    possible. Members are bucketed by each (card they have, card they need)
+    pair and swaps pair the buckets of opposite pairs, which keeps the work
+    linear in the size of the team. A swap is only made if it fills one
+    need of each of its cards without lowering what the rest of that card's
+    holders can still fill. The remaining holders and needers of each card
+    are then matched as one-way transfers.
+
+    :param members: Iterable of ``(user_id, have_cards, need_cards)``
+
+    :returns: Transfers; both halves of a swap share a ``swap_id`` and
+        one-way transfers have a ``swap_id`` of ``None``
+    :rtype: list
+    """
+    have = dict()
+    need = dict()
+    holders = defaultdict(set)
+    needers = defaultdict(set)
+    # (card given, card received) -> members who have and need those cards
+    buckets = defaultdict(deque)
+    order = list()
+
+    for user_id, have_cards, need_cards in members:
+        have[user_id] = have_cards or 0
+        need[user_id] = need_cards or 0
+        order.append(user_id)
+        for card in mask_to_cards(need[user_id]):
+            needers[card].add(user_id)
+        for card in mask_to_cards(have[user_id]):
+            holders[card].add(user_id)
+            for wanted in mask_to_cards(need[user_id]):
+                if wanted != card:
+                    buckets[(card, wanted)].append(user_id)
+
+    def pop_member(bucket, give, get, exclude=None):
+        """Pops the first member of a bucket who still has ``give`` and
+        needs ``get``, other than ``exclude``.
+        """
+        found = None
+        skipped = None
+
+        while bucket and found is None:
+            user_id = bucket.popleft()
+            if not (have[user_id] & card_bit(give) and
+                    need[user_id] & card_bit(get)):
+                continue
+
+            if user_id == exclude:
+                skipped = user_id
+            else:
+                found = user_id
+
+        if skipped is not None:
+            bucket.appendleft(skipped)
+
+        return found
+
+    def transfer(giver, receiver, card):
+        have[giver] &= ~card_bit(card)
+        need[receiver] &= ~card_bit(card)
+        holders[card].discard(giver)
+        needers[card].discard(receiver)
+
+    def keeps_capacity(giver, receiver, card):
+        """Whether giving the card costs the rest of its holders nothing."""
+        card_holders, card_needers = holders[card], needers[card]
+        capacity = card_capacity(card_holders, card_needers)
+
+        # Only a card left with one holder and one needer can lose more.
+        if len(card_holders) == len(card_needers) == 2:
+            remaining = card_capacity(
+                card_holders - {giver}, card_needers - {receiver})
+        else:
+            remaining = min(len(card_holders), len(card_needers)) - 1
+
+        return remaining == capacity - 1
+
+    transfers = list()
+    swap_id = 0
+
+    # Greedily pair mutual swaps, one card each way.
+    for give in range(1, CARD_COUNT + 1):
+        for get in range(give + 1, CARD_COUNT + 1):
+            forward = buckets.get((give, get))
+            backward = buckets.get((get, give))
+            if not (forward and backward):
+                continue
+
+            while True:
+                user_id = pop_member(forward, give, get)
+                if user_id is None:
+                    break
+
+                other = pop_member(backward, get, give, exclude=user_id)
+                if other is None:
+                    forward.appendleft(user_id)
+                    break
+
+                if not (keeps_capacity(user_id, other, give) and
+                        keeps_capacity(other, user_id, get)):
+                    # The other member is left to the one-way transfers.
+                    forward.appendleft(user_id)
+                    continue
+
+                swap_id += 1
+                transfers.append(Transfer(user_id, other, give, swap_id))
+                transfers.append(Transfer(other, user_id, get, swap_id))
+                transfer(user_id, other, give)
+                transfer(other, user_id, get)
+
+    # Fill the remaining needs of each card with the remaining holders.
+    for card in range(1, CARD_COUNT + 1):
+        givers = [u for u in order if u in holders[card]]
+        receivers = [u for u in order if u in needers[card]]
+
+        for giver, receiver in match_card(givers, receivers):
+            transfers.append(Transfer(giver, receiver, card, None))
+
+    return transfers
@@ -0,0 +1,76 @@
+import logging
+
+from sqlalchemy import or_
+
+from jtg.database import get_session
+from jtg.models import SlackTeams, SlackUsers, TradePlans
+
+from planner import plan_trades
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def load_members(session, team_id):
+    return session.query(SlackUsers)\
+        .with_entities(
+            SlackUsers.user_id, SlackUsers.have_cards, SlackUsers.need_cards)\
+        .filter(
+            SlackUsers.slack_team_id == team_id,
+            or_(SlackUsers.have_cards != 0, SlackUsers.need_cards != 0)
+        ).all()
+
+
+def save_plan(session, team_id, transfers):
+    """Replaces the team's stored plan in a single transaction."""
+    session.query(TradePlans).filter(
+        TradePlans.slack_team_id == team_id).delete(synchronize_session=False)
+
+    session.bulk_insert_mappings(TradePlans, [
+        {
+            'slack_team_id': team_id,
+            'giver_user_id': t.giver,
+            'receiver_user_id': t.receiver,
+            'card': t.card,
+            'swap_id': t.swap_id
+        } for t in transfers
+    ])
+    session.commit()
+
+
+def plan_team(session, team):
+    members = load_members(session, team.id)
+    transfers = plan_trades(members)
+
+    logger.info(
+        f'Team {team.team_id}: {len(members)} members, '
+        f'{len(transfers)} transfers planned')
+
+    try:
+        save_plan(session, team.id, transfers)
+    except:
+        logger.exception(f'Unable to save the trade plan for {team.team_id}')
+        session.rollback()
+        raise
+
+    return len(transfers)
+
+
+def lambda_handler(event, context):
+    """Plans trades for every team, or only for ``event['team_id']`` when it
+    is given. Runs on a schedule and can also be invoked on demand.
+    """
+    session = get_session()
+
+    try:
+        query = session.query(SlackTeams).with_entities(
+            SlackTeams.id, SlackTeams.team_id)
+        if event.get('team_id'):
+            query = query.filter(SlackTeams.team_id == event['team_id'])
+
+        results = {
+            team.team_id: plan_team(session, team) for team in query.all()}
+    finally:
+        session.close()
+
+    return {'Teams': results}
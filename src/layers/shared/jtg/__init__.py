@@ -0,0 +1,4 @@
+"""Code shared by the Jamf The Gathering functions, deployed as a Lambda
+layer. Submodules are imported individually so functions only pay for what
+they use.
+"""
@@ -0,0 +1,299 @@
+import logging
+import os
+import time
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+from jtg.cache import TTLCache
+from jtg.models import Session
+
+logger = logging.getLogger()
+
+DATABASE_ENDPOINT = os.getenv('DATABASE_ENDPOINT')
+DATABASE_PORT = os.getenv('DATABASE_PORT')
+DATABASE_USERNAME = os.getenv('DATABASE_USERNAME')
+DATABASE_PASSWORD = os.getenv('DATABASE_PASSWORD')
+
+# Overrides the Aurora connection, e.g. 'sqlite:///local.db' for local runs
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Read-only queries go to the Aurora reader endpoint when it is set.
+# DATABASE_READER_URL overrides it like DATABASE_URL does for the writer.
+DATABASE_READER_ENDPOINT = os.getenv('DATABASE_READER_ENDPOINT')
+DATABASE_READER_URL = os.getenv('DATABASE_READER_URL')
+# Seconds after a write during which the writer's reads stay on the writer,
+# covering the reader's replication lag.
+READ_YOUR_WRITES_WINDOW = int(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+# Seconds to use the writer for reads after the reader fails to connect
+DATABASE_READER_RETRY_AFTER = int(
+    os.getenv('DATABASE_READER_RETRY_AFTER', 30))
+
+# 'single' keeps one persistent connection per container, 'queue' a bounded
+# pool of DATABASE_POOL_SIZE connections and 'null' connects for every
+# session.
+DATABASE_POOL = os.getenv('DATABASE_POOL', 'single')
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 2))
+DATABASE_POOL_TIMEOUT = float(os.getenv('DATABASE_POOL_TIMEOUT', 5))
+# Connections older than this are replaced. Keep it below the Aurora
+# Serverless SecondsUntilAutoPause so paused clusters don't leave stale
+# sockets in warm containers.
+DATABASE_POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', 240))
+DATABASE_PRE_PING = bool(int(os.getenv('DATABASE_PRE_PING', 1)))
+DATABASE_CONNECT_TIMEOUT = int(os.getenv('DATABASE_CONNECT_TIMEOUT', 5))
+DATABASE_CONNECT_RETRIES = int(os.getenv('DATABASE_CONNECT_RETRIES', 2))
+DATABASE_CONNECT_RETRY_DELAY = float(
+    os.getenv('DATABASE_CONNECT_RETRY_DELAY', 1))
+
+_engine = None
+_reader_engine = None
+_reader_down_until = 0
+
+recent_writes = TTLCache(maxsize=10000, ttl=READ_YOUR_WRITES_WINDOW)
+
+router_stats = {
+    'reader_sessions': 0,
+    'read_your_writes': 0,
+    'reader_fallbacks': 0
+}
+
+pool_stats = {
+    'connects': 0,
+    'connect_retries': 0,
+    'checkouts': 0,
+    'invalidations': 0
+}
+
+
+def database_url(endpoint=None):
+    if DATABASE_URL and not endpoint:
+        return DATABASE_URL
+
+    return f'mysql+pymysql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@' \
+           f'{endpoint or DATABASE_ENDPOINT}:{DATABASE_PORT}/' \
+           f'jamfthegathering?charset=utf8'
+
+
+def reader_database_url():
+    """Returns the URL of the reader, or None if no reader is configured."""
+    if DATABASE_READER_URL:
+        return DATABASE_READER_URL
+
+    if DATABASE_READER_ENDPOINT:
+        return database_url(DATABASE_READER_ENDPOINT)
+
+    return None
+
+
+def pool_options(pool=DATABASE_POOL):
+    """Returns the ``create_engine`` pool arguments for a pooling strategy.
+
+    :param str pool: ``null``, ``single`` or ``queue``
+
+    :rtype: dict
+    """
+    if pool == 'null':
+        return {'poolclass': NullPool}
+
+    options = {
+        'poolclass': QueuePool,
+        'pool_timeout': DATABASE_POOL_TIMEOUT,
+        'pool_recycle': DATABASE_POOL_RECYCLE,
+        'pool_pre_ping': DATABASE_PRE_PING
+    }
+
+    if pool == 'single':
+        options.update(pool_size=1, max_overflow=0)
+    elif pool == 'queue':
+        options.update(pool_size=DATABASE_POOL_SIZE, max_overflow=0)
+    else:
+        raise ValueError(f'Unknown DATABASE_POOL: {pool}')
+
+    return options
+
+
+def pool_status():
+    """Returns the connection counters, including how many checkouts reused
+    an existing connection rather than opening a new one. The counters of
+    both engines are combined, and the routing counters are added once the
+    reader is in use.
+    """
+    stats = dict(pool_stats)
+    stats['reuses'] = max(stats['checkouts'] - stats['connects'], 0)
+
+    if _reader_engine is not None:
+        stats.update(router_stats)
+
+    return stats
+
+
+def _track_pool(engine):
+    def on_connect(dbapi_connection, connection_record):
+        pool_stats['connects'] += 1
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_stats['checkouts'] += 1
+
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        pool_stats['invalidations'] += 1
+
+    event.listen(engine, 'connect', on_connect)
+    event.listen(engine, 'checkout', on_checkout)
+    event.listen(engine, 'invalidate', on_invalidate)
+
+
+def build_engine(url, pool=DATABASE_POOL, retries=DATABASE_CONNECT_RETRIES):
+    """Creates an engine with the configured pooling strategy.
+
+    New connections are retried up to ``retries`` times with exponential
+    backoff, which covers an Aurora Serverless cluster resuming from a
+    pause. MySQL connections also get a connect timeout.
+    """
+    engine = None
+    connect_args = dict()
+
+    if url.startswith('mysql'):
+        connect_args['connect_timeout'] = DATABASE_CONNECT_TIMEOUT
+
+    def creator():
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        cparams.update(connect_args)
+
+        for attempt in range(retries + 1):
+            try:
+                return engine.dialect.connect(*cargs, **cparams)
+            except engine.dialect.dbapi.OperationalError:
+                if attempt == retries:
+                    raise
+
+                pool_stats['connect_retries'] += 1
+                delay = DATABASE_CONNECT_RETRY_DELAY * 2 ** attempt
+                logger.warning(
+                    f'Database connection failed, retrying in {delay}s...')
+                time.sleep(delay)
+
+    engine = create_engine(url, creator=creator, **pool_options(pool))
+    _track_pool(engine)
+
+    return engine
+
+
+def get_engine():
+    """Returns the engine, creating it on first use. The MySQL dialect and
+    PyMySQL are only imported at that point, so invocations that never reach
+    the database skip that cost.
+    """
+    global _engine
+
+    if _engine is None:
+        _engine = build_engine(database_url())
+
+    return _engine
+
+
+def get_reader_engine():
+    """Returns the reader engine, creating it on first use, or None if no
+    reader is configured. Connections aren't retried as the writer is used
+    when the reader is unavailable.
+    """
+    global _reader_engine
+
+    if _reader_engine is None:
+        url = reader_database_url()
+        if url:
+            _reader_engine = build_engine(url, retries=0)
+
+    return _reader_engine
+
+
+def note_write(key):
+    """Records that ``key`` (e.g. a user's ID) just wrote to the database,
+    so its reads stay on the writer for ``READ_YOUR_WRITES_WINDOW`` seconds.
+    """
+    recent_writes.set(key, True)
+
+
+def recently_wrote(key):
+    if key is not None and recent_writes.get(key):
+        router_stats['read_your_writes'] += 1
+        return True
+
+    return False
+
+
+def get_read_session(key=None):
+    """Returns a new session bound to the reader, or None when reads should
+    use the writer: no reader is configured, ``key`` wrote within the
+    read-your-writes window or the reader recently failed to connect.
+
+    The session's connection is opened here so a reader that is down is
+    detected before any query runs.
+    """
+    global _reader_down_until
+
+    if recently_wrote(key):
+        return None
+
+    engine = get_reader_engine()
+    if engine is None:
+        return None
+
+    if time.monotonic() < _reader_down_until:
+        router_stats['reader_fallbacks'] += 1
+        return None
+
+    session = Session(bind=engine)
+    try:
+        session.connection()
+    except exc.DBAPIError:
+        logger.exception('Unable to connect to the database reader')
+        session.close()
+        _reader_down_until = time.monotonic() + DATABASE_READER_RETRY_AFTER
+        router_stats['reader_fallbacks'] += 1
+        return None
+
+    router_stats['reader_sessions'] += 1
+    return session
+
+
+def insert_ignore_duplicates(session, table, rows):
+    """Inserts rows in one statement, leaving rows that already exist under
+    a unique key untouched. Uses ``INSERT ... ON DUPLICATE KEY UPDATE`` on
+    MySQL and ``INSERT OR IGNORE`` on SQLite.
+
+    :param table: The ``Table`` to insert into
+    :param list rows: Dictionaries of column values
+    """
+    dialect = session.get_bind().dialect.name
+
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+
+        pk = table.primary_key.columns.values()[0]
+        statement = insert(table).values(rows)\
+            .on_duplicate_key_update(**{pk.name: pk})
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE').values(rows)
+    else:
+        statement = table.insert().values(rows)
+
+    session.execute(statement)
+
+
+def get_session(read_only=False, key=None):
+    """Returns a new session bound to the engine. Functions can still call
+    ``Session.configure()`` at import time to set other session options.
+
+    :param bool read_only: Use the reader when it is available
+    :param key: Keeps the reads on the writer if it recently wrote, see
+        ``note_write()``
+    """
+    if read_only:
+        session = get_read_session(key)
+        if session is not None:
+            return session
+
+    if Session.kw.get('bind') is None:
+        Session.configure(bind=get_engine())
+
+    return Session()
@@ -0,0 +1,120 @@
+import logging
+import os
+import time
+
+from jtg.cache import TTLCache
+
+logger = logging.getLogger()
+
+IDEMPOTENCY_TABLE = os.getenv('IDEMPOTENCY_TABLE')
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 900))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+
+# The events API checks keys inside Slack's 3 second acknowledgement window,
+# so DynamoDB calls get short timeouts and aren't retried. A failed check
+# lets the event through.
+IDEMPOTENCY_CONNECT_TIMEOUT = float(
+    os.getenv('IDEMPOTENCY_CONNECT_TIMEOUT', 0.5))
+IDEMPOTENCY_READ_TIMEOUT = float(os.getenv('IDEMPOTENCY_READ_TIMEOUT', 0.5))
+
+
+class IdempotencyStore(object):
+    """Remembers keys that have been seen for ``ttl`` seconds so repeated
+    deliveries of the same Slack event can be dropped.
+
+    Keys are kept in memory, which covers retries that reach the same warm
+    container. When a DynamoDB table name is given, keys are also written
+    to it with a conditional put so retries that reach other containers are
+    caught too. The table's TTL attribute is ``expires_at``.
+
+    :param str scope: Prefix for the keys, so each function that shares the
+        table tracks its own deliveries
+    """
+    def __init__(self, scope, table_name=IDEMPOTENCY_TABLE,
+                 ttl=IDEMPOTENCY_TTL, maxsize=IDEMPOTENCY_CACHE_SIZE):
+        self.scope = scope
+        self.table_name = table_name
+        self.ttl = ttl
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.duplicates = 0
+        self._client = None
+
+    def get_client(self):
+        if self._client is None:
+            import boto3
+            from botocore.config import Config
+
+            self._client = boto3.client(
+                'dynamodb',
+                config=Config(
+                    connect_timeout=IDEMPOTENCY_CONNECT_TIMEOUT,
+                    read_timeout=IDEMPOTENCY_READ_TIMEOUT,
+                    retries={'max_attempts': 0}
+                )
+            )
+
+        return self._client
+
+    def claim_in_table(self, key):
+        client = self.get_client()
+
+        try:
+            client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'id': {'S': key},
+                    'expires_at': {'N': str(int(time.time()) + self.ttl)}
+                },
+                ConditionExpression='attribute_not_exists(id) OR '
+                                    'expires_at < :now',
+                ExpressionAttributeValues={
+                    ':now': {'N': str(int(time.time()))}
+                }
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        except Exception:
+            # Processing an event twice is better than dropping it.
+            logger.exception(f'Unable to check idempotency key {key}')
+
+        return True
+
+    def claim(self, key):
+        """Records the key and returns whether this is the first time it has
+        been seen. Returns True for an empty key.
+
+        :rtype: bool
+        """
+        if not key:
+            return True
+
+        key = f'{self.scope}:{key}'
+
+        if self.cache.get(key):
+            self.duplicates += 1
+            return False
+
+        self.cache.set(key, True)
+
+        if self.table_name and not self.claim_in_table(key):
+            self.duplicates += 1
+            return False
+
+        return True
+
+    def release(self, key):
+        """Forgets a claimed key so a redelivery of an event that failed to
+        process isn't dropped as a duplicate.
+        """
+        if not key:
+            return
+
+        key = f'{self.scope}:{key}'
+        self.cache.invalidate(key)
+
+        if self.table_name:
+            try:
+                self.get_client().delete_item(
+                    TableName=self.table_name, Key={'id': {'S': key}})
+            except Exception:
+                logger.exception(f'Unable to release idempotency key {key}')
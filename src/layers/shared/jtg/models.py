@@ -0,0 +1,164 @@
+from datetime import datetime
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, Integer, String, ForeignKey, Index,
+    UniqueConstraint)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, sessionmaker
+
+Base = declarative_base()
+Session = sessionmaker()
+
+CARD_COUNT = 18
+ALL_CARDS = (1 << CARD_COUNT) - 1
+
+
+def card_bit(card):
+    """Returns the bit for a card number (card 1 is bit 0)."""
+    return 1 << (card - 1)
+
+
+def cards_to_mask(card_list):
+    mask = 0
+    for i in card_list:
+        if 0 < i <= CARD_COUNT:
+            mask |= card_bit(i)
+
+    return mask
+
+
+def mask_to_cards(mask):
+    return [i for i in range(1, CARD_COUNT + 1) if mask & card_bit(i)]
+
+
+class SlackTeams(Base):
+    __tablename__ = 'slack_teams'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    team_id = Column(String(16), nullable=False, unique=True)
+    team_name = Column(String(128), nullable=False)
+    access_token = Column(String(128), nullable=False)
+    bot_user_id = Column(String(12), nullable=False)
+    bot_access_token = Column(String(64), nullable=False)
+
+    # Increased whenever a member's cards change, so results computed from
+    # the team's cards can be cached until the next change.
+    cards_version = Column(
+        Integer, nullable=False, default=0, server_default='0')
+
+    users = relationship("SlackUsers", back_populates="slack_team")
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'team_id': self.team_id,
+            'team_name': self.team_name,
+            'bot_user_id': self.bot_user_id
+        }
+
+
+class SlackUsers(Base):
+    __tablename__ = 'slack_users'
+    __table_args__ = (
+        UniqueConstraint(
+            'slack_team_id', 'user_id', name='uq_slack_users_team_user'),
+        Index('ix_slack_users_team_notify', 'slack_team_id', 'notify'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String(12), nullable=False)
+
+    have_cards = Column(Integer, nullable=False, default=0)
+    need_cards = Column(Integer, nullable=False, default=0)
+
+    # Opted in to direct messages about new trade matches
+    notify = Column(
+        Boolean, nullable=False, default=False, server_default='0')
+
+    slack_team_id = Column(Integer, ForeignKey('slack_teams.id'))
+    slack_team = relationship('SlackTeams', back_populates='users')
+
+    def get_cards(self, type_):
+        """Returns the sorted card numbers flagged for the given type.
+
+        :param str type_: ``have`` or ``need``
+
+        :rtype: list
+        """
+        return mask_to_cards(getattr(self, f'{type_}_cards') or 0)
+
+    def serialize(self):
+        def attr_gttr(type_):
+            mask = getattr(self, f'{type_}_cards') or 0
+            return {
+                f'{type_}_{i}': bool(mask & card_bit(i))
+                for i in range(1, CARD_COUNT + 1)
+            }
+
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'slack_team_id': self.slack_team_id,
+            'notify': self.notify,
+            'has': attr_gttr('have'),
+            'needs': attr_gttr('need')
+        }
+
+
+class NotifyCards(Base):
+    """Reverse index of the cards flagged by members who opted in to
+    notifications, with one row per member, type and card. A card change
+    looks up the teammates it matches by card instead of scanning the team.
+    """
+    __tablename__ = 'notify_cards'
+    __table_args__ = (
+        Index('ix_notify_cards_user', 'slack_user_id'),
+    )
+
+    slack_team_id = Column(
+        Integer, ForeignKey('slack_teams.id'), primary_key=True)
+    card_type = Column(String(4), primary_key=True)
+    card = Column(Integer, primary_key=True, autoincrement=False)
+    slack_user_id = Column(
+        Integer, ForeignKey('slack_users.id'), primary_key=True)
+
+
+class TradePlans(Base):
+    """One card transfer in a team's trade plan. Both halves of a swap share
+    a ``swap_id``; one-way transfers have none.
+    """
+    __tablename__ = 'trade_plans'
+    __table_args__ = (
+        Index('ix_trade_plans_team_giver', 'slack_team_id', 'giver_user_id'),
+        Index('ix_trade_plans_team_receiver',
+              'slack_team_id', 'receiver_user_id'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    slack_team_id = Column(
+        Integer, ForeignKey('slack_teams.id'), nullable=False)
+    giver_user_id = Column(String(12), nullable=False)
+    receiver_user_id = Column(String(12), nullable=False)
+    card = Column(Integer, nullable=False)
+    swap_id = Column(Integer)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'slack_team_id': self.slack_team_id,
+            'giver_user_id': self.giver_user_id,
+            'receiver_user_id': self.receiver_user_id,
+            'card': self.card,
+            'swap_id': self.swap_id,
+            'created_at': self.created_at.isoformat()
+        }
+
+
+class SchemaMigrations(Base):
+    """A schema migration applied by the database initializer."""
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(128), nullable=False)
+    applied_at = Column(DateTime, nullable=False, default=datetime.utcnow)
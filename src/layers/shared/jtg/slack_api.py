@@ -0,0 +1,150 @@
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger()
+
+SLACK_API_URL = os.getenv('SLACK_API_URL', 'https://slack.com/api')
+SLACK_API_TIMEOUT = float(os.getenv('SLACK_API_TIMEOUT', 5))
+SLACK_API_RETRIES = int(os.getenv('SLACK_API_RETRIES', 2))
+SLACK_API_MAX_RETRY_AFTER = float(os.getenv('SLACK_API_MAX_RETRY_AFTER', 5))
+SLACK_API_POOL_SIZE = int(os.getenv('SLACK_API_POOL_SIZE', 10))
+
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 2.0
+
+_session = None
+_latency_hooks = list()
+
+
+class SlackApiError(Exception):
+    pass
+
+
+def get_session():
+    """Returns the shared ``requests`` session. It is created on first use
+    and kept at module level so warm invocations reuse the pooled
+    keep-alive connections to Slack instead of repeating the TLS handshake.
+    ``requests`` is imported here rather than at module level to keep it out
+    of the cold start of invocations that never call Slack.
+    """
+    global _session
+
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=SLACK_API_POOL_SIZE,
+            max_retries=0
+        )
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+
+    return _session
+
+
+def add_latency_hook(func):
+    """Registers ``func(method, status_code, elapsed_ms, attempt)`` to be
+    called after every Slack API request. ``status_code`` is ``None`` when
+    the request failed without a response.
+    """
+    _latency_hooks.append(func)
+
+
+def _report(method, status_code, elapsed_ms, attempt):
+    logger.info(
+        f'Slack API {method}: {status_code} in {elapsed_ms:.1f}ms '
+        f'(attempt {attempt + 1})'
+    )
+    for func in _latency_hooks:
+        func(method, status_code, elapsed_ms, attempt)
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _retry_after(r):
+    try:
+        return float(r.headers.get('Retry-After', 1))
+    except ValueError:
+        return 1.0
+
+
+def call(method, token=None, json=None, data=None, timeout=None,
+         retries=None):
+    """Calls a Slack Web API method and returns the decoded JSON body.
+
+    Connection errors and 5xx responses are retried up to ``retries`` times
+    (``SLACK_API_RETRIES`` by default) with jittered exponential backoff. ``429``
+    responses wait for the ``Retry-After`` header unless it is longer than
+    ``SLACK_API_MAX_RETRY_AFTER``.
+
+    :param str method: API method, e.g. ``chat.postMessage``
+    :param str token: Bearer token for the request
+    :param dict json: JSON request body
+    :param dict data: Form encoded request body
+    :param int retries: Retries for this call. Pass 0 for methods that must
+        not be sent twice, such as exchanging a single use OAuth code.
+
+    :raises SlackApiError: The request did not succeed after all retries or
+        the response wasn't JSON
+
+    :rtype: dict
+    """
+    from requests import RequestException
+
+    url = f'{SLACK_API_URL}/{method}'
+    headers = {'Authorization': f'Bearer {token}'} if token else None
+    session = get_session()
+    retries = SLACK_API_RETRIES if retries is None else retries
+
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        start = time.monotonic()
+
+        try:
+            r = session.post(
+                url,
+                json=json,
+                data=data,
+                headers=headers,
+                timeout=timeout or SLACK_API_TIMEOUT
+            )
+        except RequestException as error:
+            _report(method, None, (time.monotonic() - start) * 1000, attempt)
+            if last_attempt:
+                raise SlackApiError(f'{method} failed: {error}')
+
+            time.sleep(_backoff(attempt))
+            continue
+
+        _report(method, r.status_code, (time.monotonic() - start) * 1000,
+                attempt)
+
+        if r.status_code == 429:
+            delay = _retry_after(r)
+            if last_attempt or delay > SLACK_API_MAX_RETRY_AFTER:
+                raise SlackApiError(
+                    f'{method} was rate limited (Retry-After: {delay})')
+
+            time.sleep(delay + random.uniform(0, BACKOFF_BASE))
+            continue
+
+        if r.status_code >= 500:
+            if last_attempt:
+                raise SlackApiError(f'{method} failed: {r.status_code}')
+
+            time.sleep(_backoff(attempt))
+            continue
+
+        try:
+            return r.json()
+        except ValueError:
+            # E.g. an HTML error page from a proxy
+            raise SlackApiError(
+                f'{method} returned a non-JSON {r.status_code} response')